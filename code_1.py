@@ -1,18 +1,52 @@
-from flask import Flask, render_template_string, request, jsonify, session
+from flask import Flask, render_template_string, request, jsonify, session, Response, stream_with_context
 import folium
 from geopy.geocoders import Nominatim
 import ssl
 import certifi
-from functools import lru_cache
 import requests
 from requests import Session
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
 import re
 from datetime import datetime
 import json
 import os
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse, urlencode
 import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FuturesTimeout
+from geopy.extra.rate_limiter import RateLimiter
+import sqlite3
+import threading
+import atexit
+import hashlib
+import math
+import heapq
+from array import array
+import csv
+import uuid
+from collections import OrderedDict
+
+try:
+    import aiohttp  # Необязательно: без него запросы идут через общую сессию requests в потоках
+except ImportError:
+    aiohttp = None
+
+# Необязательные быстрые парсеры HTML
+try:
+    import lxml  # noqa: F401 — нужен только как бэкенд BeautifulSoup
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser as SelectolaxParser  # Старые версии selectolax
+    except ImportError:
+        SelectolaxParser = None
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'  # Замените на ваш секретный ключ
@@ -20,21 +54,975 @@ app.secret_key = 'your_secret_key'  # Замените на ваш секрет
 # Фикс SSL проблем для geopy
 ssl_context = ssl.create_default_context(cafile=certifi.where())
 
-# Кешируем геокодирование для уменьшения запросов к API
-@lru_cache(maxsize=100)
-def search_locations(query):
-    geolocator = Nominatim(
-        user_agent="map_application",
-        ssl_context=ssl_context,
-        timeout=20
+# Общий HTTP-клиент для всех внешних запросов: пул keep-alive соединений
+# на каждый хост и повторы с экспоненциальной задержкой
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.5))
+
+def create_http_session():
+    """Создаём сессию с пулом соединений и повторами для временных ошибок"""
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True
+    )
+    # pool_maxsize — сколько соединений держим открытыми к одному хосту,
+    # pool_connections — для скольких хостов храним пулы
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    http = Session()
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+http_session = create_http_session()
+
+# Файл с постоянными кешами, общий для всех воркеров
+CACHE_DB_PATH = os.environ.get('TREASURE_CACHE_DB', 'treasure_cache.sqlite3')
+
+# Маркер промаха кеша (None — допустимое закешированное значение)
+_CACHE_MISS = object()
+
+class SqliteCache:
+    """Постоянный кеш ключ-значение в SQLite с TTL и вытеснением по LRU.
+
+    Каждое пространство имён живёт в своей таблице общего файла базы.
+    Режим WAL позволяет нескольким процессам читать и писать одновременно.
+    Значения хранятся в JSON. Соединение открывается лениво в каждом процессе,
+    поэтому кеш можно создать до fork (gunicorn --preload).
+    """
+
+    # Как часто (в записях) проверять превышение размера
+    EVICT_EVERY = 100
+    # Время обращения для LRU обновляем, только если оно старше этой доли TTL:
+    # иначе каждое попадание было бы записью в базу
+    TOUCH_FRACTION = 0.1
+
+    def __init__(self, namespace, ttl=7 * 24 * 3600, max_entries=10000, path=CACHE_DB_PATH):
+        self.table = f"cache_{namespace}"
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        """Соединение текущего процесса; после fork открываем новое"""
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._pid = os.getpid()
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                'created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            self._conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table}(accessed_at)'
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                f'SELECT value, created_at, accessed_at FROM {self.table} WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            if now - row[1] > self.ttl:
+                conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                conn.commit()
+                self.misses += 1
+                return default
+            # Отмечаем обращение для LRU, если прошлая отметка устарела
+            if now - row[2] > self.ttl * self.TOUCH_FRACTION:
+                conn.execute(
+                    f'UPDATE {self.table} SET accessed_at = ? WHERE key = ?', (now, key)
+                )
+                conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, value, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), now, now)
+            )
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict(conn, now)
+            conn.commit()
+
+    def _evict(self, conn, now):
+        """Удаляем просроченные записи и самые давние сверх лимита"""
+        conn.execute(f'DELETE FROM {self.table} WHERE created_at < ?', (now - self.ttl,))
+        conn.execute(
+            f'DELETE FROM {self.table} WHERE key IN ('
+            f'SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def stats(self):
+        with self._lock:
+            size = self._connect().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+        return {'backend': 'sqlite', 'size': size, 'hits': self.hits, 'misses': self.misses}
+
+class MemoryCache:
+    """Кеш в памяти процесса с тем же интерфейсом, что и SqliteCache.
+
+    Подходит для разработки и одиночного воркера: TTL и LRU по размеру,
+    но содержимое теряется при перезапуске.
+    """
+
+    def __init__(self, namespace, ttl=7 * 24 * 3600, max_entries=10000, path=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                self._data.pop(key, None)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._data)
+        return {'backend': 'memory', 'size': size, 'hits': self.hits, 'misses': self.misses}
+
+# Доступные реализации кеша, выбираются по имени из настроек
+CACHE_BACKENDS = {
+    'sqlite': SqliteCache,
+    'memory': MemoryCache
+}
+
+def normalize_query(query):
+    """Приводим поисковый запрос к ключу кеша: регистр, пробелы, ё -> е"""
+    return ' '.join(query.casefold().replace('ё', 'е').split())
+
+class SingleFlight:
+    """Склеиваем одинаковые одновременные вызовы внутри процесса.
+
+    Первый вызов с ключом выполняет функцию, остальные с тем же ключом
+    ждут его и получают тот же результат (или то же исключение).
+    Ключ забывается сразу после завершения — это не кеш.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._calls)
+        return {'in_flight': in_flight, 'leaders': self.leaders, 'coalesced': self.coalesced}
+
+# Общий на процесс; первым элементом ключа идёт имя операции
+singleflight = SingleFlight()
+
+# Шаг сетки обратного геокодирования в градусах (~1 км):
+# все точки одной ячейки получают один и тот же адрес
+REVERSE_GEOCODE_GRID = 0.01
+
+def quantize_coords(lat, lon, step=REVERSE_GEOCODE_GRID):
+    """Привязываем координаты к узлу сетки с шагом step"""
+    return round(round(lat / step) * step, 6), round(round(lon / step) * step, 6)
+
+# Один геокодер на процесс, не чаще 1 запроса в секунду (правила Nominatim)
+reverse_geolocator = Nominatim(user_agent="treasure_app", ssl_context=ssl_context, timeout=20)
+_rate_limited_reverse = RateLimiter(
+    reverse_geolocator.reverse,
+    min_delay_seconds=1,
+    swallow_exceptions=False
+)
+reverse_geocode_cache = SqliteCache('reverse_geocode', ttl=30 * 24 * 3600, max_entries=50000)
+
+def reverse_geocode(lat, lon):
+    """Получаем адрес точки через общий кеш обратного геокодирования.
+
+    Возвращает строку адреса или None, если Nominatim ничего не нашёл.
+    Ошибки сети не кешируются.
+    """
+    cell_lat, cell_lon = quantize_coords(lat, lon)
+    key = f"{cell_lat:.6f},{cell_lon:.6f}"
+
+    address = reverse_geocode_cache.get(key, _CACHE_MISS)
+    if address is not _CACHE_MISS:
+        return address
+
+    # Одновременные запросы по одной ячейке ждут один общий запрос к Nominatim
+    return singleflight.do(('reverse_geocode', key), _reverse_geocode_cell, key, lat, lon)
+
+def _reverse_geocode_cell(key, lat, lon):
+    # Пока ждали, ячейку мог разрешить другой процесс
+    address = reverse_geocode_cache.get(key, _CACHE_MISS)
+    if address is not _CACHE_MISS:
+        return address
+
+    try:
+        location = _rate_limited_reverse(f"{lat}, {lon}", language='ru')
+    except Exception as e:
+        print(f"Reverse geocoding error: {e}")
+        return None
+
+    address = location.address if location else None
+    reverse_geocode_cache.set(key, address)
+    return address
+
+# Локальный справочник населённых пунктов (необязательный)
+GAZETTEER_DB_PATH = os.environ.get('GAZETTEER_DB', 'gazetteer.sqlite3')
+
+class Gazetteer:
+    """Офлайн-индекс мест для мгновенного поиска без обращения к Nominatim.
+
+    Дамп GeoNames (RU.txt, формат allCountries) или CSV с колонками
+    name, lat, lon[, population, alt_names, region] импортируется один раз:
+
+        python -c "import code_1; code_1.gazetteer.import_dump('RU.txt')"
+
+    Все названия (включая альтернативные) нормализуются так же, как ключи
+    геокэша, и лежат в B-дереве, поэтому поиск по префиксу — это один
+    индексный диапазонный запрос. Если файла индекса нет, поиск просто
+    возвращает пустой список. К подписи места добавляется регион, чтобы
+    тёзки («Ивановка», «Покровка») различались в списке результатов.
+    """
+
+    # Классы объектов GeoNames: P — населённые пункты, A — административные единицы
+    FEATURE_CLASSES = ('P', 'A')
+    BATCH_SIZE = 5000
+
+    def __init__(self, path=GAZETTEER_DB_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None and os.path.exists(self.path):
+            self._conn = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+        return self._conn
+
+    def search(self, query, limit=10):
+        """Ищем места по точному совпадению или префиксу названия"""
+        key = normalize_query(query)
+        if not key:
+            return []
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return []
+            # Префикс задаём диапазоном [key, key + максимальный символ)
+            rows = conn.execute(
+                'SELECT p.display_name, p.lat, p.lon '
+                'FROM gazetteer_names n JOIN gazetteer_places p ON p.id = n.place_id '
+                'WHERE n.name_norm >= ? AND n.name_norm < ? '
+                'GROUP BY p.id '
+                'ORDER BY MAX(n.name_norm = ?) DESC, p.population DESC '
+                'LIMIT ?',
+                (key, key + '\U0010ffff', key, limit)
+            ).fetchall()
+        return [
+            {'address': name, 'latitude': lat, 'longitude': lon}
+            for name, lat, lon in rows
+        ]
+
+    def import_dump(self, dump_path, country='RU'):
+        """Импортируем дамп в новый файл индекса и атомарно подменяем старый"""
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        conn = sqlite3.connect(tmp_path)
+        conn.execute(
+            'CREATE TABLE gazetteer_places ('
+            'id INTEGER PRIMARY KEY, display_name TEXT NOT NULL, '
+            'lat REAL NOT NULL, lon REAL NOT NULL, population INTEGER NOT NULL)'
+        )
+        conn.execute('CREATE TABLE gazetteer_names (name_norm TEXT NOT NULL, place_id INTEGER NOT NULL)')
+
+        if dump_path.endswith('.csv'):
+            records = self._read_csv(dump_path)
+        else:
+            records = self._read_geonames(dump_path, country)
+
+        places, names = [], []
+        count = 0
+        for place_id, (name, alt_names, lat, lon, population, region) in enumerate(records, start=1):
+            display_name = self._display_name(name, alt_names)
+            if region and region != display_name:
+                display_name = f"{display_name}, {region}"
+            places.append((place_id, display_name, lat, lon, population))
+            for norm in {normalize_query(n) for n in [name] + alt_names if n}:
+                names.append((norm, place_id))
+            count += 1
+            if len(places) >= self.BATCH_SIZE:
+                self._flush(conn, places, names)
+
+        self._flush(conn, places, names)
+        # Индекс строим после загрузки — так заметно быстрее
+        conn.execute('CREATE INDEX gazetteer_names_norm ON gazetteer_names(name_norm)')
+        conn.commit()
+        conn.execute('VACUUM')
+        conn.close()
+
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            os.replace(tmp_path, self.path)
+        print(f"Gazetteer imported: {count} places")
+        return count
+
+    @staticmethod
+    def _display_name(name, alt_names):
+        """Для подписи предпочитаем русское название, если оно есть"""
+        return next(
+            (n for n in [name] + alt_names if re.search('[а-яё]', n, re.IGNORECASE)),
+            name
+        )
+
+    @staticmethod
+    def _flush(conn, places, names):
+        conn.executemany('INSERT INTO gazetteer_places VALUES (?, ?, ?, ?, ?)', places)
+        conn.executemany('INSERT INTO gazetteer_names VALUES (?, ?)', names)
+        places.clear()
+        names.clear()
+
+    def _read_geonames(self, dump_path, country):
+        # Первый проход: названия регионов по коду admin1 (поле 10)
+        # из записей ADM1 того же дампа
+        regions = {}
+        for fields in self._geonames_rows(dump_path, country):
+            if fields[7] == 'ADM1':
+                alt_names = [n for n in fields[3].split(',') if n]
+                regions[fields[10]] = self._display_name(fields[1], alt_names)
+
+        for fields in self._geonames_rows(dump_path, country):
+            if fields[6] not in self.FEATURE_CLASSES:
+                continue
+            alt_names = [n for n in fields[3].split(',') if n]
+            yield (
+                fields[1], alt_names, float(fields[4]), float(fields[5]),
+                int(fields[14] or 0), regions.get(fields[10])
+            )
+
+    @staticmethod
+    def _geonames_rows(dump_path, country):
+        with open(dump_path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 15:
+                    continue
+                if country and fields[8] != country:
+                    continue
+                yield fields
+
+    @staticmethod
+    def _read_csv(dump_path):
+        with open(dump_path, encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                alt_names = [n for n in (row.get('alt_names') or '').split(',') if n]
+                yield (
+                    row['name'], alt_names, float(row['lat']), float(row['lon']),
+                    int(row.get('population') or 0), row.get('region') or None
+                )
+
+gazetteer = Gazetteer()
+
+# Кешируем геокодирование для уменьшения запросов к API.
+# Кеш общий для всех воркеров и переживает перезапуск
+GEOCODE_CACHE_BACKEND = os.environ.get('GEOCODE_CACHE_BACKEND', 'sqlite')
+geocode_cache = CACHE_BACKENDS[GEOCODE_CACHE_BACKEND]('geocode', ttl=30 * 24 * 3600, max_entries=20000)
+
+geolocator = Nominatim(
+    user_agent="map_application",
+    ssl_context=ssl_context,
+    timeout=20
+)
+_rate_limited_geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1, swallow_exceptions=False)
+
+def geocode_locations(query):
+    """Как search_locations, но ошибка геокодера пробрасывается наружу.
+    Пустой список означает, что место действительно не найдено."""
+    # Сначала пробуем локальный справочник, в Nominatim идём только при промахе
+    local_results = gazetteer.search(query)
+    if local_results:
+        return local_results
+
+    key = normalize_query(query)
+    cached = geocode_cache.get(key, _CACHE_MISS)
+    if cached is not _CACHE_MISS:
+        return cached
+
+    # Ошибки не кешируем, чтобы повторить запрос в следующий раз
+    locations = singleflight.do(
+        ('geocode', key), _rate_limited_geocode, query, country_codes='RU', exactly_one=False
     )
+    results = [
+        {'address': loc.address, 'latitude': loc.latitude, 'longitude': loc.longitude}
+        for loc in (locations or [])
+    ]
+    geocode_cache.set(key, results)
+    return results
+
+def search_locations(query):
+    """Ищем места по запросу, результат — список словарей с адресом и координатами"""
     try:
-        locations = geolocator.geocode(query, country_codes='RU', exactly_one=False)
-        return locations if locations else []
+        return geocode_locations(query)
     except Exception as e:
         print(f"Geocoding error: {e}")
         return []
 
+# Средняя длина градуса широты в километрах
+KM_PER_DEGREE = 111.195
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Расстояние между точками по поверхности Земли в километрах"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * 6371.0088 * math.asin(min(1.0, math.sqrt(a)))
+
+# Кодирование координат точек: float64 — без потерь, float32 — около 1 м,
+# fixed — целые в единицах 1e-7 градуса (около 1 см)
+POINT_ENCODING = os.environ.get('POINT_ENCODING', 'float64')
+
+class CompactPointStore:
+    """Столбцовое хранилище координат без отдельного объекта на каждую точку.
+
+    Широты и долготы лежат в двух array: 16 байт на точку для float64
+    и 8 байт для float32 и fixed против ~100 байт у кортежа из двух float.
+    """
+
+    # Кодирование -> (код типа array, множитель)
+    ENCODINGS = {
+        'float64': ('d', 1),
+        'float32': ('f', 1),
+        'fixed': ('i', 10 ** 7)
+    }
+
+    def __init__(self, encoding='float64'):
+        typecode, self.scale = self.ENCODINGS[encoding]
+        self.encoding = encoding
+        self.lats = array(typecode)
+        self.lons = array(typecode)
+
+    def append(self, lat, lon):
+        if self.scale == 1:
+            self.lats.append(lat)
+            self.lons.append(lon)
+        else:
+            self.lats.append(round(lat * self.scale))
+            self.lons.append(round(lon * self.scale))
+
+    def __len__(self):
+        return len(self.lons)
+
+    def get(self, number):
+        return self.lats[number] / self.scale, self.lons[number] / self.scale
+
+    def __iter__(self):
+        # Снимок на момент начала обхода: дописывание во время итерации безопасно.
+        # Долгота дописывается последней, поэтому по ней считаем готовые точки
+        count = len(self.lons)
+        lats, lons, scale = self.lats[:count], self.lons[:count], self.scale
+        if scale == 1:
+            return zip(lats, lons)
+        return ((lat / scale, lon / scale) for lat, lon in zip(lats, lons))
+
+    def column_bytes(self):
+        """Сырые буферы столбцов (один memcpy, без объектов на точку)"""
+        count = len(self.lons)
+        return self.lats[:count].tobytes(), self.lons[:count].tobytes()
+
+    def iter_json(self, chunk_size=5000):
+        """JSON-массив пар [lat, lon] по кускам, без списка пар целиком"""
+        count = len(self.lons)
+        scale = self.scale
+        yield '['
+        for start in range(0, count, chunk_size):
+            stop = min(start + chunk_size, count)
+            pairs = zip(self.lats[start:stop], self.lons[start:stop])
+            if scale == 1:
+                chunk = ','.join(f'[{lat!r},{lon!r}]' for lat, lon in pairs)
+            else:
+                chunk = ','.join(f'[{lat / scale!r},{lon / scale!r}]' for lat, lon in pairs)
+            yield chunk if start == 0 else ',' + chunk
+        yield ']'
+
+class PointIndex:
+    """Пространственный индекс точек на равномерной сетке ячеек.
+
+    Координаты лежат в CompactPointStore, а каждая ячейка сетки хранит
+    номера своих точек, поэтому запрос касается только нужных ячеек.
+    Снаружи ведёт себя как список кортежей (lat, lon): append, len, итерация.
+    """
+
+    def __init__(self, points=(), cell_size=0.05, encoding='float64'):
+        self.cell_size = cell_size
+        self.coords = CompactPointStore(encoding)
+        self.version = 0
+        self._cells = {}
+        self._lock = threading.Lock()
+        for point in points:
+            self.append(point)
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def append(self, point):
+        lat, lon = point
+        with self._lock:
+            # Сначала координаты, потом ячейка: читатели без блокировки
+            # никогда не увидят номер точки раньше её координат
+            number = len(self.coords)
+            self.coords.append(lat, lon)
+            self._cells.setdefault(self._cell(lat, lon), array('i')).append(number)
+            self.version += 1
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __iter__(self):
+        return iter(self.coords)
+
+    def __getitem__(self, number):
+        return self.coords.get(number)
+
+    def column_bytes(self):
+        return self.coords.column_bytes()
+
+    def iter_json(self):
+        return self.coords.iter_json()
+
+    def digest(self):
+        """Отпечаток состояния для ключей кеша без обхода всех точек"""
+        return f"index:{id(self)}:{self.version}"
+
+    def _numbers_in_cells(self, south, west, north, east):
+        min_row, min_col = self._cell(south, west)
+        max_row, max_col = self._cell(north, east)
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self._cells):
+            # Прямоугольник покрывает больше ячеек, чем занято: обходим занятые
+            for (row, col), numbers in list(self._cells.items()):
+                if min_row <= row <= max_row and min_col <= col <= max_col:
+                    yield from numbers
+            return
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                yield from self._cells.get((row, col), ())
+
+    def bbox(self, south, west, north, east):
+        """Точки внутри прямоугольника"""
+        get = self.coords.get
+        found = []
+        for n in self._numbers_in_cells(south, west, north, east):
+            lat, lon = get(n)
+            if south <= lat <= north and west <= lon <= east:
+                found.append((lat, lon))
+        return found
+
+    def radius(self, lat, lon, radius_km):
+        """Точки в радиусе radius_km, от ближних к дальним: [(км, (lat, lon)), ...]"""
+        d_lat = radius_km / KM_PER_DEGREE
+        d_lon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        found = []
+        for point_lat, point_lon in self.bbox(lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon):
+            distance = haversine_km(lat, lon, point_lat, point_lon)
+            if distance <= radius_km:
+                found.append((distance, (point_lat, point_lon)))
+        found.sort()
+        return found
+
+    @staticmethod
+    def _ring(center_row, center_col, ring):
+        """Ячейки на границе квадратного кольца радиуса ring"""
+        if ring == 0:
+            yield center_row, center_col
+            return
+        for col in range(center_col - ring, center_col + ring + 1):
+            yield center_row - ring, col
+            yield center_row + ring, col
+        for row in range(center_row - ring + 1, center_row + ring):
+            yield row, center_col - ring
+            yield row, center_col + ring
+
+    def nearest(self, lat, lon, k=10):
+        """k ближайших точек: обходим кольца ячеек, пока ближе уже не найти"""
+        total = len(self)
+        center_row, center_col = self._cell(lat, lon)
+        best = []  # куча (-расстояние, номер) из k лучших
+
+        def consider(numbers):
+            for n in numbers:
+                distance = haversine_km(lat, lon, *self.coords.get(n))
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, n))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, n))
+
+        ring = 0
+        while total:
+            if (2 * ring + 1) ** 2 > len(self._cells):
+                # Просмотренный квадрат больше числа занятых ячеек:
+                # дешевле досмотреть оставшиеся занятые ячейки целиком
+                for (row, col), numbers in list(self._cells.items()):
+                    if max(abs(row - center_row), abs(col - center_col)) >= ring:
+                        consider(numbers)
+                break
+            for cell in self._ring(center_row, center_col, ring):
+                consider(self._cells.get(cell, ()))
+            # Любая точка за этим кольцом не ближе ring ячеек от центра
+            min_lat = math.radians(min(89.9, abs(lat) + (ring + 1) * self.cell_size))
+            bound_km = ring * self.cell_size * KM_PER_DEGREE * math.cos(min_lat)
+            if len(best) == k and bound_km >= -best[0][0]:
+                break
+            ring += 1
+        return sorted(
+            (-neg_distance, self.coords.get(n)) for neg_distance, n in best
+        )
+
+# Хранилище точек и маршрутов. SQLite в режиме WAL — общий файл для всех воркеров
+POINTS_DB_PATH = os.environ.get('TREASURE_POINTS_DB', 'treasure_points.sqlite3')
+POINT_STORAGE_BACKEND = os.environ.get('POINT_STORAGE_BACKEND', 'sqlite')
+
+class SqlitePointStorage:
+    """Постоянное хранилище точек и текущего маршрута в SQLite.
+
+    Точки добавляются пачками в одной транзакции, а читаются диапазоном
+    по первичному ключу, так что воркеры догружают только новые записи.
+    """
+
+    def __init__(self, path=POINTS_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS points ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'lat REAL NOT NULL, lon REAL NOT NULL, created_at REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS routes ('
+            'name TEXT PRIMARY KEY, points TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+
+    def add_points(self, points):
+        """Записываем пачку точек, возвращаем присвоенные им id"""
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE сразу берёт блокировку записи, поэтому id в пачке идут подряд
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany(
+                    'INSERT INTO points (lat, lon, created_at) VALUES (?, ?, ?)',
+                    [(lat, lon, now) for lat, lon in points]
+                )
+                last_id = self._conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return list(range(last_id - len(points) + 1, last_id + 1))
+
+    def points_since(self, last_id):
+        """Точки с id больше last_id: [(id, lat, lon), ...]"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT id, lat, lon FROM points WHERE id > ? ORDER BY id', (last_id,)
+            ).fetchall()
+
+    def get_route(self, name='current'):
+        with self._lock:
+            row = self._conn.execute('SELECT points FROM routes WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def set_route(self, points, name='current'):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO routes (name, points, updated_at) VALUES (?, ?, ?)',
+                (name, json.dumps(points), time.time())
+            )
+
+class MemoryPointStorage:
+    """Хранилище в памяти процесса с тем же интерфейсом (для одного воркера и отладки)"""
+
+    def __init__(self, path=None):
+        self._points = []
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def add_points(self, points):
+        with self._lock:
+            first_id = len(self._points) + 1
+            self._points.extend(points)
+        return list(range(first_id, first_id + len(points)))
+
+    def points_since(self, last_id):
+        with self._lock:
+            return [
+                (point_id, lat, lon)
+                for point_id, (lat, lon) in enumerate(self._points[last_id:], start=last_id + 1)
+            ]
+
+    def get_route(self, name='current'):
+        with self._lock:
+            return list(self._routes.get(name, []))
+
+    def set_route(self, points, name='current'):
+        with self._lock:
+            self._routes[name] = list(points)
+
+# Доступные реализации хранилища, выбираются по имени из настроек
+POINT_STORAGES = {
+    'sqlite': SqlitePointStorage,
+    'memory': MemoryPointStorage
+}
+
+point_storage = POINT_STORAGES[POINT_STORAGE_BACKEND](POINTS_DB_PATH)
+
+class SharedPoints:
+    """Точки находок: постоянное хранилище плюс локальный пространственный индекс.
+
+    Новые точки сразу попадают в индекс, а в хранилище уходят пачками
+    (по размеру или по таймеру). Точки других воркеров догружаются
+    в индекс по возрастанию id не чаще раза в SYNC_INTERVAL секунд.
+    Интерфейс чтения тот же, что у PointIndex.
+    """
+
+    WRITE_BATCH_SIZE = 50
+    WRITE_FLUSH_INTERVAL = 1.0
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.index = PointIndex(encoding=POINT_ENCODING)
+        self._last_id = 0
+        self._own_ids = set()
+        self._pending = []
+        self._timer = None
+        self._synced_at = None
+        self._lock = threading.RLock()
+        atexit.register(self.flush)
+
+    def append(self, point):
+        with self._lock:
+            self.index.append(point)
+            self._pending.append(point)
+            if len(self._pending) >= self.WRITE_BATCH_SIZE:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.WRITE_FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Записываем накопленные точки в хранилище одной пачкой"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            try:
+                ids = self.storage.add_points(pending)
+            except Exception as e:
+                # Вернём точки в очередь, они уйдут со следующей пачкой
+                print(f"Point storage error: {e}")
+                self._pending = pending + self._pending
+                return
+            # Свои точки уже есть в индексе, при синхронизации их пропускаем
+            self._own_ids.update(ids)
+
+    def sync(self):
+        """Догружаем в индекс точки, записанные другими воркерами"""
+        now = time.monotonic()
+        with self._lock:
+            if self._synced_at is not None and now - self._synced_at < self.SYNC_INTERVAL:
+                return
+            self._synced_at = now
+            try:
+                rows = self.storage.points_since(self._last_id)
+            except Exception as e:
+                print(f"Point storage error: {e}")
+                return
+            for point_id, lat, lon in rows:
+                if point_id in self._own_ids:
+                    self._own_ids.discard(point_id)
+                else:
+                    self.index.append((lat, lon))
+                self._last_id = point_id
+
+    def __len__(self):
+        self.sync()
+        return len(self.index)
+
+    def __iter__(self):
+        self.sync()
+        return iter(self.index)
+
+    def bbox(self, south, west, north, east):
+        self.sync()
+        return self.index.bbox(south, west, north, east)
+
+    def radius(self, lat, lon, radius_km):
+        self.sync()
+        return self.index.radius(lat, lon, radius_km)
+
+    def nearest(self, lat, lon, k=10):
+        self.sync()
+        return self.index.nearest(lat, lon, k)
+
+    def digest(self):
+        self.sync()
+        return self.index.digest()
+
+    def column_bytes(self):
+        self.sync()
+        return self.index.column_bytes()
+
+    def iter_json(self):
+        self.sync()
+        return self.index.iter_json()
+
+    @property
+    def encoding(self):
+        return self.index.coords.encoding
+
+# При большем числе точек маркеры на карте объединяются в кластеры
+MARKER_CLUSTER_THRESHOLD = 200
+# Размер ячейки кластера в пикселях экрана
+CLUSTER_CELL_PX = 60
+# Область вокруг центра карты (в пикселях), для которой сервер рисует кластеры
+VIEWPORT_WIDTH_PX = 2560
+VIEWPORT_HEIGHT_PX = 1600
+
+def viewport_bbox(lat, lon, zoom, width_px=VIEWPORT_WIDTH_PX, height_px=VIEWPORT_HEIGHT_PX):
+    """Примерные границы (юг, запад, север, восток) видимой области карты"""
+    deg_per_px = 360 / (256 * 2 ** zoom)
+    half_width = width_px * deg_per_px / 2
+    # В проекции Меркатора градус широты на экране длиннее в 1 / cos(lat) раз
+    half_height = height_px * deg_per_px / 2 * math.cos(math.radians(lat))
+    return lat - half_height, lon - half_width, lat + half_height, lon + half_width
+
+def points_in_bbox(points, south, west, north, east):
+    """Отбираем точки, попадающие в прямоугольник"""
+    if hasattr(points, 'bbox'):
+        return points.bbox(south, west, north, east)
+    return [
+        (lat, lon) for lat, lon in points
+        if south <= lat <= north and west <= lon <= east
+    ]
+
+def cluster_points(points, zoom):
+    """Группируем точки по ячейкам сетки, размер которой зависит от масштаба.
+
+    Возвращает список (lat, lon, count) с центром масс каждой ячейки,
+    для одиночных точек count == 1.
+    """
+    cell = 360 / (256 * 2 ** zoom) * CLUSTER_CELL_PX
+    cells = {}
+    for lat, lon in points:
+        key = (math.floor(lat / cell), math.floor(lon / cell))
+        acc = cells.get(key)
+        if acc is None:
+            cells[key] = [lat, lon, 1]
+        else:
+            acc[0] += lat
+            acc[1] += lon
+            acc[2] += 1
+    return [(sum_lat / n, sum_lon / n, n) for sum_lat, sum_lon, n in cells.values()]
+
+def add_point_clusters(m, points, lat, lon, zoom):
+    """Рисуем кластеры только для окрестности видимой области.
+
+    Размер карты не зависит от общего числа точек: остальное браузер
+    догружает через /api/points?bbox=... при перемещении карты.
+    """
+    south, west, north, east = viewport_bbox(lat, lon, zoom)
+    group = folium.FeatureGroup(name='Находки')
+    for c_lat, c_lon, count in cluster_points(points_in_bbox(points, south, west, north, east), zoom):
+        if count == 1:
+            folium.Marker(
+                location=[c_lat, c_lon],
+                popup=f"Точка: {c_lat}, {c_lon}",
+                icon=folium.Icon(color='red', icon='treasure-sign', prefix='fa')
+            ).add_to(group)
+        else:
+            folium.CircleMarker(
+                location=[c_lat, c_lon],
+                radius=min(10 + 3 * math.log2(count), 30),
+                color='#8B4513',
+                fill=True,
+                fill_color='#F4A460',
+                fill_opacity=0.8,
+                tooltip=f"Находок: {count}",
+                bubbling_mouse_events=False  # Клик по кластеру не доходит до карты
+            ).add_to(group)
+    group.add_to(m)
+
 def create_map(lat, lon, points=None, routes=None, zoom_start=15, map_layer='satellite', old_map=False):
     tile_urls = {
         'satellite': 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
@@ -59,7 +1047,9 @@ def create_map(lat, lon, points=None, routes=None, zoom_start=15, map_layer='sat
             control=True
         ).add_to(m)
 
-    if points:
+    if points and len(points) > MARKER_CLUSTER_THRESHOLD:
+        add_point_clusters(m, points, lat, lon, zoom_start)
+    elif points:
         for point in points:
             folium.Marker(
                 location=[point[0], point[1]],
@@ -75,11 +1065,35 @@ def create_map(lat, lon, points=None, routes=None, zoom_start=15, map_layer='sat
 
     return m
 
+# Кеш готового HTML карт: сборка и сериализация folium — самая дорогая часть
+# отрисовки страницы, а одинаковые карты запрашиваются постоянно
+MAP_RENDER_CACHE_SIZE = 64
+map_render_cache = MemoryCache('map_render', ttl=3600, max_entries=MAP_RENDER_CACHE_SIZE)
+
+def _digest(items):
+    """Короткий отпечаток списка точек или маршрута для ключа кеша"""
+    if hasattr(items, 'digest'):
+        return items.digest()
+    return hashlib.blake2b(repr(items).encode(), digest_size=16).hexdigest()
+
+def render_map(lat, lon, points=None, routes=None, zoom_start=15, map_layer='satellite', old_map=False):
+    """Возвращаем HTML карты, собирая её через create_map только при промахе кеша"""
+    key = (
+        round(lat, 6), round(lon, 6), zoom_start, map_layer, bool(old_map),
+        _digest(points or []), _digest(routes or [])
+    )
+    html = map_render_cache.get(key)
+    if html is None:
+        m = create_map(lat, lon, points, routes, zoom_start=zoom_start, map_layer=map_layer, old_map=old_map)
+        html = m._repr_html_()
+        map_render_cache.set(key, html)
+    return html
+
 def get_weather(lat, lon):
     """Получаем текущую температуру в пиратском стиле"""
     try:
         url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true"
-        response = requests.get(url, timeout=20)
+        response = http_session.get(url, timeout=20)
         data = response.json()
 
         # Проверяем, что данные содержат нужные поля
@@ -113,38 +1127,799 @@ def get_weather(lat, lon):
         print(f"Weather API error: {e}")
         return None
 
-def parse_clad_sites(location_name):
-    """Парсим тематические сайты о кладах в указанном регионе"""
-    sites = [
-        ("http://samara-clad.ru/", "div.post-content"),
-        ("https://samarafishing.ru/board/index.php?topic=40553.0", "div.post"),
-        ("https://mdrussia.ru/topic/89888-samarskaja-oblast/", "div.msg")
-    ]
+# Кеш загруженных страниц. Свежая копия отдаётся без запроса, устаревшая
+# перепроверяется условным GET (ETag / Last-Modified): ответ 304 продлевает её
+# без повторной загрузки тела.
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 6 * 3600))
+PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 500))
+# Устаревшие страницы храним дольше TTL, чтобы было что перепроверять
+page_cache = SqliteCache('pages', ttl=30 * 24 * 3600, max_entries=PAGE_CACHE_SIZE)
+
+def _conditional_headers(entry, headers):
+    """Добавляем к запросу валидаторы сохранённой копии"""
+    headers = dict(headers or {})
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def _remember_page(url, entry, status, text, response_headers):
+    """Обновляем кеш по ответу сервера и возвращаем актуальный текст страницы.
+    Страницу с ошибкой парсерам не отдаём: есть копия — возвращаем её, нет — исключение."""
+    if status == 304 and entry is not None:
+        entry['fetched_at'] = time.time()
+        page_cache.set(url, entry)
+        return entry['text']
+    if status == 200:
+        page_cache.set(url, {
+            'text': text,
+            'etag': response_headers.get('ETag'),
+            'last_modified': response_headers.get('Last-Modified'),
+            'fetched_at': time.time()
+        })
+        return text
+    return _stale_page(url, entry, requests.HTTPError(f"{status} for {url}"))
+
+def _stale_page(url, entry, error):
+    """Сервер не отдал страницу: возвращаем устаревшую копию, если она есть"""
+    if entry is None:
+        raise error
+    print(f"Page refresh failed for {url}, serving cached copy: {error}")
+    return entry['text']
+
+def _fresh_page(url):
+    """Возвращаем (запись кеша, признак свежести)"""
+    entry = page_cache.get(url)
+    fresh = entry is not None and time.time() - entry['fetched_at'] < PAGE_CACHE_TTL
+    return entry, fresh
+
+def cached_get(url, headers=None, timeout=20):
+    """Получаем текст страницы через кеш с условной перепроверкой"""
+    entry, fresh = _fresh_page(url)
+    if fresh:
+        return entry['text']
+    return singleflight.do(('page', url), _revalidate_page, url, entry, headers, timeout)
+
+def _revalidate_page(url, entry, headers, timeout):
+    try:
+        response = http_session.get(url, headers=_conditional_headers(entry, headers), timeout=timeout)
+    except Exception as e:
+        return _stale_page(url, entry, e)
+    return _remember_page(url, entry, response.status_code, response.text, response.headers)
+
+# Источники для парсинга
+CLAD_SITES = [
+    ("http://samara-clad.ru/", "div.post-content"),
+    ("https://samarafishing.ru/board/index.php?topic=40553.0", "div.post"),
+    ("https://mdrussia.ru/topic/89888-samarskaja-oblast/", "div.msg")
+]
+WIKIPEDIA_BASE_URL = "https://ru.wikipedia.org"
+WIKIPEDIA_API_URL = f"{WIKIPEDIA_BASE_URL}/w/api.php"
+# 'api' — вступления статей через MediaWiki API, 'html' — разбор страниц сайта
+WIKIPEDIA_BACKEND = os.environ.get('WIKIPEDIA_BACKEND', 'api')
+WIKIPEDIA_GEOSEARCH_RADIUS_M = 10000  # Максимум, который допускает API
+WIKIPEDIA_PAGE_LIMIT = 5
+WIKIPEDIA_API_HEADERS = {'User-Agent': 'treasure_app/1.0 (MediaWiki API client)'}
+PRIVOLGE_URL = "https://privolge.ru/ischeznuvshie-derevni/"
+ETOMESTO_SEARCH_URL = "https://www.etomesto.ru/search/?query={query}"
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
+# Бюджет просмотра списков Privolge и Etomesto: сколько совпадений и символов
+# набрать, прежде чем прекратить обход страницы
+SCAN_MAX_HITS = int(os.environ.get('SCAN_MAX_HITS', 5))
+SCAN_MAX_CHARS = int(os.environ.get('SCAN_MAX_CHARS', 6000))
+
+# Слой разбора HTML. Бэкенд BeautifulSoup — lxml, если он установлен, иначе
+# html.parser. Перед разбором страница сужается до нужных блоков: selectolax
+# быстро вырезает их по CSS-селектору, без него — SoupStrainer, который
+# строит дерево только для совпавших тегов.
+HTML_PARSER = os.environ.get('HTML_PARSER', 'lxml' if HAS_LXML else 'html.parser')
+HTML_PREFILTER = os.environ.get('HTML_PREFILTER', 'selectolax' if SelectolaxParser else 'strainer')
+HTML_PREFILTERS = ('selectolax', 'strainer', 'none')
+
+def strainer_for(selector):
+    """SoupStrainer для простых селекторов вида «tag», «tag.class», «tag#id»
+    и их перечисления через запятую с одним тегом. Для прочих — None."""
+    tag = None
+    classes = []
+    element_id = None
+    for part in selector.split(','):
+        match = re.fullmatch(r'\s*([a-z0-9]+)(?:\.([\w-]+)|#([\w-]+))?\s*', part)
+        if match is None or (tag is not None and match.group(1) != tag):
+            return None
+        tag = match.group(1)
+        if match.group(2):
+            classes.append(match.group(2))
+        elif match.group(3):
+            element_id = match.group(3)
+        else:
+            return SoupStrainer(tag)
+    if element_id is not None:
+        return SoupStrainer(tag, id=element_id) if not classes else None
+    return SoupStrainer(tag, class_=classes) if classes else SoupStrainer(tag)
+
+def _select_fragments(html, selector):
+    """Вырезаем из страницы HTML блоков, подходящих под селектор (selectolax)"""
+    nodes = SelectolaxParser(html).css(selector)
+    matched = {node.mem_id for node in nodes}
+    fragments = []
+    for node in nodes:
+        # Вложенные совпадения уже входят во внешний блок
+        parent = node.parent
+        while parent is not None and parent.mem_id not in matched:
+            parent = parent.parent
+        if parent is None:
+            fragments.append(node.html)
+    return ''.join(fragments)
+
+def make_soup(html, selector=None, parser=None, prefilter=None):
+    """Разбираем страницу; с селектором — только подходящие под него блоки"""
+    parser = parser or HTML_PARSER
+    prefilter = prefilter or HTML_PREFILTER
+    if selector is None or prefilter == 'none':
+        return BeautifulSoup(html, parser)
+    if prefilter == 'selectolax' and SelectolaxParser is not None:
+        return BeautifulSoup(_select_fragments(html, selector), parser)
+    return BeautifulSoup(html, parser, parse_only=strainer_for(selector))
+
+# Какой селектор использовать для сохранённой страницы — по подстроке в имени файла
+PARSER_FIXTURE_SELECTORS = {
+    'samara-clad': 'div.post-content',
+    'samarafishing': 'div.post',
+    'mdrussia': 'div.msg',
+    'wikipedia': 'div#mw-content-text',
+    'privolge': 'article',
+    'etomesto': 'div.search-item'
+}
+
+def benchmark_parsers(fixture_dir, repeat=5):
+    """Сравниваем бэкенды разбора на сохранённых страницах (*.html в fixture_dir).
+
+    Возвращает {(парсер, предфильтр): среднее время разбора всех страниц в секундах}
+    и печатает таблицу. Пример: python -c "import code_1; code_1.benchmark_parsers('fixtures')"
+    """
+    pages = []
+    for name in sorted(os.listdir(fixture_dir)):
+        if not name.endswith('.html'):
+            continue
+        with open(os.path.join(fixture_dir, name), encoding='utf-8', errors='replace') as f:
+            html = f.read()
+        selector = next(
+            (sel for key, sel in PARSER_FIXTURE_SELECTORS.items() if key in name), None
+        )
+        pages.append((html, selector))
+
+    parsers = ['html.parser'] + (['lxml'] if HAS_LXML else [])
+    prefilters = [p for p in HTML_PREFILTERS if p != 'selectolax' or SelectolaxParser is not None]
+    results = {}
+    for parser in parsers:
+        for prefilter in prefilters:
+            started = time.perf_counter()
+            for _ in range(repeat):
+                for html, selector in pages:
+                    make_soup(html, selector, parser=parser, prefilter=prefilter)
+            results[(parser, prefilter)] = (time.perf_counter() - started) / repeat
+
+    print(f"{len(pages)} pages, {repeat} runs")
+    for (parser, prefilter), seconds in sorted(results.items(), key=lambda item: item[1]):
+        print(f"{parser:12} {prefilter:11} {seconds * 1000:9.1f} ms")
+    return results
+
+# Извлечение текста за один проход по дереву: слова собираются по мере обхода,
+# обход прекращается на лимите длины, а поиск подстроки идёт по кускам текста
+# без сборки и копирования всей страницы
+
+def iter_words(node):
+    """Слова видимого текста узла по порядку (без скриптов, стилей и комментариев)"""
+    for string in node.strings:
+        yield from string.split()
+
+def extract_text(node, limit=None):
+    """Текст узла с одиночными пробелами, не длиннее limit символов.
 
+    Даёт то же, что ' '.join(node.get_text(' ', strip=True).split())[:limit],
+    но не читает дерево дальше, чем нужно для лимита.
+    """
+    parts = []
+    size = -1  # Длина ' '.join(parts)
+    for word in iter_words(node):
+        parts.append(word)
+        size += len(word) + 1
+        if limit is not None and size >= limit:
+            break
+    text = ' '.join(parts)
+    return text if limit is None else text[:limit]
+
+def contains_text(node, needle):
+    """Встречается ли needle в тексте узла без учёта регистра и лишних пробелов.
+
+    Граница между текстовыми узлами считается пробелом, как в extract_text:
+    «Красный<br>Яр» совпадает с «Красный Яр», а «<p>foo</p><p>bar</p>» с «foobar» — нет.
+    Текст проверяется кусками по мере обхода; между кусками хранится только
+    хвост длиной в needle, чтобы не пропустить совпадение на стыке.
+    """
+    needle = ' '.join(needle.casefold().split())
+    if not needle:
+        return True
+    keep = len(needle) - 1
+    tail = ''
+    for string in node.strings:
+        chunk = ' '.join(string.casefold().split())
+        if not chunk:
+            continue
+        window = f"{tail} {chunk}" if tail else chunk
+        if needle in window:
+            return True
+        tail = window[-keep:] if keep else ''
+    return False
+
+# Разбор страниц отделён от загрузки: асинхронный конвейер скачивает
+# страницы, а парсеры выполняются в потоках через asyncio.to_thread
+
+def parse_clad_posts(html, url, selector, location_name):
+    """Выбираем посты форума, в которых упоминается местность"""
+    soup = make_soup(html, selector)
     results = []
+    for post in soup.select(selector)[:3]:  # Берем первые 3 записи
+        if contains_text(post, location_name):
+            # Берём на символ больше лимита, чтобы знать, нужно ли многоточие
+            text = extract_text(post, limit=501)
+            results.append({
+                'source': url,
+                'text': text[:500] + '...' if len(text) > 500 else text
+            })
+    return results
+
+def parse_wikipedia_search(html):
+    """Достаём ссылки на статьи и категории из выдачи поиска Википедии"""
+    soup = make_soup(html, 'div.mw-search-result-heading, div.mw-search-results')
+
+    # Ищем все ссылки на статьи, связанные с этим регионом
+    links = []
+    for link in soup.select('div.mw-search-result-heading a'):
+        href = link.get('href')
+        if href and not href.startswith('#'):
+            links.append(urljoin(WIKIPEDIA_BASE_URL, href))
+
+    # Также проверяем категории
+    for cat in soup.select('div.mw-search-results li a[href^="/wiki/Category:"]'):
+        href = cat.get('href')
+        if href:
+            links.append(urljoin(WIKIPEDIA_BASE_URL, href))
+
+    # Убираем дубликаты, сохраняя порядок выдачи
+    return list(dict.fromkeys(links))
+
+def parse_wikipedia_page(html):
+    """Получаем основной текст статьи Википедии"""
+    page_soup = make_soup(html, 'div#mw-content-text')
+    content = page_soup.find('div', {'id': 'mw-content-text'})
+    if not content:
+        return ""
+
+    # Удаляем таблицы и боковые панели
+    for element in content(['table', 'div.infobox', 'div.thumb']):
+        element.decompose()
+
+    return extract_text(content, limit=2000)  # Ограничиваем длину текста
+
+def wikipedia_api_params(location_name, lat=None, lon=None):
+    """Один запрос к MediaWiki API: поиск статей и их вступления простым текстом.
+
+    С координатами ищем статьи рядом с точкой (geosearch), без них — по названию.
+    """
+    params = {
+        'action': 'query',
+        'format': 'json',
+        'formatversion': 2,
+        'prop': 'extracts',
+        'exintro': 1,
+        'explaintext': 1,
+        'exlimit': WIKIPEDIA_PAGE_LIMIT
+    }
+    if lat is not None and lon is not None:
+        params.update({
+            'generator': 'geosearch',
+            'ggscoord': f"{lat}|{lon}",
+            'ggsradius': WIKIPEDIA_GEOSEARCH_RADIUS_M,
+            'ggslimit': WIKIPEDIA_PAGE_LIMIT
+        })
+    else:
+        params.update({
+            'generator': 'search',
+            'gsrsearch': location_name,
+            'gsrnamespace': 0,
+            'gsrlimit': WIKIPEDIA_PAGE_LIMIT
+        })
+    return params
+
+def parse_wikipedia_extracts(payload):
+    """Собираем вступления статей из ответа API в порядке выдачи"""
+    pages = payload.get('query', {}).get('pages', [])
+    pages = sorted(pages, key=lambda page: page.get('index', 0))
+
+    all_text = []
+    for page in pages:
+        text = ' '.join(page.get('extract', '').split())
+        if text:
+            all_text.append(text[:2000])  # Ограничиваем длину текста
+    return ' '.join(all_text)
+
+def parse_privolge_articles(html, location_name, max_hits=SCAN_MAX_HITS, max_chars=SCAN_MAX_CHARS):
+    """Выбираем статьи Privolge, в которых упоминается местность.
+    Обход останавливается, как только набрано max_hits статей или max_chars символов."""
+    soup = make_soup(html, 'article')
+
+    # Ищем все статьи, связанные с этим регионом
+    articles = []
+    budget = max_chars
+    for article in soup.find_all('article'):
+        if len(articles) >= max_hits or budget <= 0:
+            break
+        if contains_text(article, location_name):
+            # Удаляем ненужные элементы
+            for element in article(['script', 'style', 'iframe', 'img']):
+                element.decompose()
+
+            text = extract_text(article, limit=min(2000, budget))  # Ограничиваем длину текста
+            articles.append(text)
+            budget -= len(text) + 1
+
+    return ' '.join(articles)
+
+def parse_etomesto_items(html, location_name, max_hits=SCAN_MAX_HITS, max_chars=SCAN_MAX_CHARS):
+    """Выбираем описания карт etomesto.ru для местности.
+    Обход останавливается, как только набрано max_hits описаний или max_chars символов."""
+    soup = make_soup(html, 'div.search-item')
+
+    # Ищем информацию о картах
+    maps_info = []
+    budget = max_chars
+    for item in soup.select('div.search-item'):
+        if len(maps_info) >= max_hits or budget <= 0:
+            break
+        title = item.select_one('h3 a')
+        if title and contains_text(title, location_name):
+            desc = item.select_one('div.search-item-desc')
+            if desc:
+                text = extract_text(desc, limit=min(1000, budget))  # Ограничиваем длину текста
+                maps_info.append(text)
+                budget -= len(text) + 1
+
+    return ' '.join(maps_info)
+
+# Индекс постов форумов о кладах. Фоновый обходчик периодически забирает
+# страницы форумов и складывает все посты в SQLite с полнотекстовым индексом.
+FORUM_DB_PATH = os.environ.get('TREASURE_FORUM_DB', 'treasure_forum.sqlite3')
+# Период обхода форумов и Privolge в секундах, 0 — обходчик выключен
+FORUM_INGEST_INTERVAL = int(os.environ.get('FORUM_INGEST_INTERVAL', 0))
+
+def extract_forum_posts(html, selector):
+    """Достаём тексты всех постов страницы форума"""
+    soup = make_soup(html, selector)
+    posts = []
+    for post in soup.select(selector):
+        text = extract_text(post)
+        if text:
+            posts.append(text)
+    return posts
+
+class ForumIndex:
+    """Накопленные посты форумов с поиском по названиям мест.
+
+    Посты индексируются через FTS5 (индекс без копии текста, по нормализованным
+    словам, чтобы «ё» и «е» совпадали); если SQLite собран без него, используется
+    простой обратный индекс слов. Поиск идёт по всей накопленной истории,
+    а не по трём первым постам свежей страницы.
+    """
+
+    def __init__(self, path=FORUM_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS forum_posts ('
+            'id INTEGER PRIMARY KEY, source TEXT NOT NULL, digest TEXT NOT NULL UNIQUE, '
+            'text TEXT NOT NULL, ingested_at REAL NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS forum_meta (key TEXT PRIMARY KEY, value REAL NOT NULL);'
+        )
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS forum_posts_fts USING fts5("
+                "text, content='', "
+                "tokenize='unicode61 remove_diacritics 2')"
+            )
+            self.fts = True
+        except sqlite3.OperationalError:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS forum_terms ('
+                'term TEXT NOT NULL, post_id INTEGER NOT NULL, '
+                'PRIMARY KEY (term, post_id)) WITHOUT ROWID'
+            )
+            self.fts = False
+        self._conn.commit()
+
+    @staticmethod
+    def _terms(text):
+        return re.findall(r'\w+', normalize_query(text))
+
+    def add_posts(self, source, texts):
+        """Добавляем новые посты, уже известные пропускаем. Возвращаем число новых."""
+        now = time.time()
+        added = 0
+        with self._lock:
+            for text in texts:
+                digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO forum_posts (source, digest, text, ingested_at) '
+                    'VALUES (?, ?, ?, ?)',
+                    (source, digest, text, now)
+                )
+                if not cursor.rowcount:
+                    continue
+                post_id = cursor.lastrowid
+                if self.fts:
+                    self._conn.execute(
+                        'INSERT INTO forum_posts_fts (rowid, text) VALUES (?, ?)',
+                        (post_id, normalize_query(text))
+                    )
+                else:
+                    self._conn.executemany(
+                        'INSERT OR IGNORE INTO forum_terms (term, post_id) VALUES (?, ?)',
+                        [(term, post_id) for term in set(self._terms(text))]
+                    )
+                added += 1
+            self._conn.commit()
+        return added
+
+    def has_posts(self):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM forum_posts LIMIT 1').fetchone() is not None
+
+    def search(self, location_name, limit=3):
+        """Ищем посты, где встречаются все слова названия (совпадение по началу слова)"""
+        terms = self._terms(location_name)
+        if not terms:
+            return []
+
+        with self._lock:
+            if self.fts:
+                match = ' '.join(f'"{term}"*' for term in terms)
+                rows = self._conn.execute(
+                    'SELECT p.source, p.text FROM forum_posts_fts f '
+                    'JOIN forum_posts p ON p.id = f.rowid '
+                    'WHERE forum_posts_fts MATCH ? ORDER BY bm25(forum_posts_fts) LIMIT ?',
+                    (match, limit)
+                ).fetchall()
+            else:
+                subquery = ' INTERSECT '.join(
+                    ['SELECT post_id FROM forum_terms WHERE term >= ? AND term < ?'] * len(terms)
+                )
+                params = [bound for term in terms for bound in (term, term + '\uffff')]
+                rows = self._conn.execute(
+                    f'SELECT source, text FROM forum_posts WHERE id IN ({subquery}) '
+                    'ORDER BY ingested_at DESC LIMIT ?',
+                    (*params, limit)
+                ).fetchall()
+
+        return [
+            {'source': source, 'text': text[:500] + '...' if len(text) > 500 else text}
+            for source, text in rows
+        ]
+
+    def claim_ingest(self, interval):
+        """Решаем, чей воркер выполняет очередной обход, чтобы не обходить форумы несколько раз"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            row = self._conn.execute(
+                "SELECT value FROM forum_meta WHERE key = 'last_ingest'"
+            ).fetchone()
+            if row is not None and now - row[0] < interval:
+                self._conn.rollback()
+                return False
+            self._conn.execute(
+                "INSERT OR REPLACE INTO forum_meta (key, value) VALUES ('last_ingest', ?)", (now,)
+            )
+            self._conn.commit()
+        return True
+
+forum_index = ForumIndex()
 
-    for url, selector in sites:
+def ingest_forums():
+    """Обходим форумы и добавляем новые посты в индекс"""
+    for url, selector in CLAD_SITES:
         try:
-            response = requests.get(url, timeout=20)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            posts = soup.select(selector)
-
-            for post in posts[:3]:  # Берем первые 3 записи
-                text = post.get_text(separator=' ', strip=True)
-                if location_name.lower() in text.lower():
-                    # Очищаем текст от лишних пробелов и переносов
-                    text = ' '.join(text.split())
-                    results.append({
-                        'source': url,
-                        'text': text[:500] + '...' if len(text) > 500 else text
-                    })
-                    if len(results) >= 3:  # Ограничиваемся 3 результатами
-                        break
+            added = forum_index.add_posts(url, extract_forum_posts(cached_get(url), selector))
+            print(f"Forum ingest {url}: {added} new posts")
         except Exception as e:
-            print(f"Error parsing {url}: {e}")
+            print(f"Forum ingest error {url}: {e}")
+
+# Справочник исчезнувших деревень Privolge: список разбирается один раз
+# при обходе, деревни геокодируются и ищутся по имени и по расстоянию
+VILLAGES_DB_PATH = os.environ.get('TREASURE_VILLAGES_DB', 'treasure_villages.sqlite3')
+# Регион добавляется к названию при геокодировании, чтобы не найти тёзку в другом крае
+VILLAGE_GEOCODE_REGION = os.environ.get('VILLAGE_GEOCODE_REGION', 'Самарская область')
+VILLAGE_GEOCODE_BATCH = 50  # Деревень за один обход: Nominatim отвечает не чаще раза в секунду
+PRIVOLGE_NEARBY_KM = 15
+VILLAGE_NAME_PREFIXES = ('деревня', 'село', 'поселок', 'хутор', 'слобода', 'выселки')
+
+def village_key(name):
+    """Ключ для поиска по имени: нормализованное название без слова «деревня» и т. п."""
+    key = normalize_query(name)
+    first, _, rest = key.partition(' ')
+    return rest if first in VILLAGE_NAME_PREFIXES and rest else key
+
+def extract_privolge_villages(html):
+    """Разбираем список исчезнувших деревень: название, ссылка на статью и текст"""
+    soup = make_soup(html, 'article')
+    villages = []
+    for article in soup.find_all('article'):
+        heading = article.find(['h1', 'h2', 'h3'])
+        if heading is None:
             continue
+        name = extract_text(heading)
+        # Ссылка на статью отличает тёзок из разных районов
+        link = heading.find('a', href=True) or article.find('a', href=True)
+        url = urljoin(PRIVOLGE_URL, link['href']) if link else ''
+
+        # Удаляем ненужные элементы
+        for element in article(['script', 'style', 'iframe', 'img']):
+            element.decompose()
+        if name:
+            villages.append({'name': name, 'url': url, 'text': extract_text(article, limit=2000)})
+    return villages
+
+class VillageIndex:
+    """Таблица деревень с индексом по имени и по координатам.
+
+    Поиск по имени — диапазон по B-дереву ключа, поиск рядом с точкой —
+    диапазон по индексу (lat, lon) внутри описанного квадрата с точной
+    проверкой расстояния.
+    """
 
-    return results
+    def __init__(self, path=VILLAGES_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        columns = {row['name'] for row in self._conn.execute('PRAGMA table_info(villages)')}
+        if columns and 'url' not in columns:
+            # Старая схема склеивала тёзок по имени; справочник заново соберёт обходчик
+            self._conn.execute('DROP TABLE villages')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS villages ('
+            'id INTEGER PRIMARY KEY, name TEXT NOT NULL, name_key TEXT NOT NULL, '
+            "url TEXT NOT NULL DEFAULT '', text TEXT NOT NULL, lat REAL, lon REAL, geocoded_at REAL, "
+            'UNIQUE (name_key, url));'
+            'CREATE INDEX IF NOT EXISTS villages_geo ON villages(lat, lon);'
+        )
+        self._conn.commit()
+
+    def upsert(self, villages):
+        with self._lock:
+            self._conn.executemany(
+                'INSERT INTO villages (name, name_key, url, text) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(name_key, url) DO UPDATE SET name = excluded.name, text = excluded.text',
+                [(v['name'], village_key(v['name']), v.get('url', ''), v['text']) for v in villages]
+            )
+            self._conn.commit()
+
+    def pending_geocode(self, limit):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT id, name FROM villages WHERE geocoded_at IS NULL LIMIT ?', (limit,)
+            ).fetchall()
+
+    def set_location(self, village_id, lat, lon):
+        """Сохраняем координаты; ненайденная деревня тоже отмечается, чтобы не геокодировать её снова"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE villages SET lat = ?, lon = ?, geocoded_at = ? WHERE id = ?',
+                (lat, lon, time.time(), village_id)
+            )
+            self._conn.commit()
+
+    def has_villages(self):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM villages LIMIT 1').fetchone() is not None
+
+    def by_name(self, name, limit=5):
+        """Деревни, чьё название начинается с запроса"""
+        key = village_key(name)
+        if not key:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT * FROM villages WHERE name_key >= ? AND name_key < ? LIMIT ?',
+                (key, key + '\uffff', limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def nearby(self, lat, lon, radius_km, limit=50):
+        """Деревни в радиусе, отсортированные по расстоянию: [(км, деревня)]"""
+        dlat = radius_km / KM_PER_DEGREE
+        dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT * FROM villages WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?',
+                (lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+            ).fetchall()
+
+        found = []
+        for row in rows:
+            distance = haversine_km(lat, lon, row['lat'], row['lon'])
+            if distance <= radius_km:
+                found.append((distance, dict(row)))
+        found.sort(key=lambda item: item[0])
+        return found[:limit]
+
+    def describe(self, location_name, lat=None, lon=None, radius_km=PRIVOLGE_NEARBY_KM, limit=5):
+        """Текст о деревнях с этим названием и исчезнувших деревнях рядом с точкой"""
+        found = {village['id']: village for village in self.by_name(location_name, limit)}
+        if lat is not None and lon is not None:
+            for _, village in self.nearby(lat, lon, radius_km, limit):
+                found.setdefault(village['id'], village)
+        return ' '.join(village['text'] for village in list(found.values())[:limit])
+
+village_index = VillageIndex()
+
+def ingest_villages():
+    """Обновляем справочник деревень Privolge и геокодируем новые"""
+    try:
+        html = cached_get(PRIVOLGE_URL, headers=BROWSER_HEADERS)
+        villages = extract_privolge_villages(html)
+        village_index.upsert(villages)
+
+        pending = village_index.pending_geocode(VILLAGE_GEOCODE_BATCH)
+        geocoded = 0
+        for village_id, name in pending:
+            try:
+                results = geocode_locations(f"{village_key(name)}, {VILLAGE_GEOCODE_REGION}")
+            except Exception as e:
+                # Геокодер недоступен: geocoded_at остаётся пустым, повторим при следующем обходе
+                print(f"Village geocoding error: {e}")
+                break
+            if results:
+                village_index.set_location(village_id, results[0]['latitude'], results[0]['longitude'])
+            else:
+                village_index.set_location(village_id, None, None)
+            geocoded += 1
+        print(f"Village ingest: {len(villages)} villages, {geocoded} of {len(pending)} geocoded")
+    except Exception as e:
+        print(f"Village ingest error: {e}")
+
+# Задачи фонового обходчика источников
+INGEST_JOBS = [ingest_forums, ingest_villages]
+
+def _ingest_loop():
+    while True:
+        try:
+            if forum_index.claim_ingest(FORUM_INGEST_INTERVAL):
+                for job in INGEST_JOBS:
+                    job()
+        except Exception as e:
+            print(f"Ingest error: {e}")
+        time.sleep(FORUM_INGEST_INTERVAL)
+
+if FORUM_INGEST_INTERVAL > 0:
+    threading.Thread(target=_ingest_loop, name='source-ingest', daemon=True).start()
+
+# Кеш ответов нейросети. Ключ — хеш модели, запроса, округлённой температуры
+# и узла сетки координат; ответ на тот же регион отдаётся сразу и бесплатно.
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', 7 * 24 * 3600))
+LLM_CACHE_SIZE = int(os.environ.get('LLM_CACHE_SIZE', 2000))
+LLM_TEMPERATURE_STEP = 0.1
+llm_cache = SqliteCache('llm', ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_SIZE)
+
+def llm_cache_key(model, prompt, temperature, location=None):
+    bucket = round(temperature / LLM_TEMPERATURE_STEP) * LLM_TEMPERATURE_STEP
+    parts = [model, f"{bucket:.2f}", prompt]
+    if location is not None:
+        parts.append('%.6f,%.6f' % quantize_coords(*location))
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+def openrouter_chat(api_key, model, prompt, temperature=0.8, location=None, timeout=30, json_mode=False,
+                    validate=None):
+    """Отправляем запрос в OpenRouter и возвращаем текст ответа.
+    Успешные ответы кешируются, ошибки пробрасываются и в кеш не попадают.
+    json_mode просит модель вернуть один JSON-объект (если модель это поддерживает).
+    validate(content) — проверка ответа: если она вернула None, ответ отдаётся, но не кешируется."""
+    key = llm_cache_key(model, prompt, temperature, location)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+
+    data = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": temperature
+    }
+    if json_mode:
+        data["response_format"] = {"type": "json_object"}
+
+    # Одинаковые запросы, пришедшие одновременно, ждут один ответ модели
+    return singleflight.do(('llm', key), _request_completion, key, api_key, data, timeout, validate)
+
+def _request_completion(key, api_key, data, timeout, validate=None):
+    response = http_session.post(
+        OPENROUTER_URL,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        },
+        json=data,
+        timeout=timeout
+    )
+    response.raise_for_status()
+    content = response.json()['choices'][0]['message']['content']
+    if validate is None or validate(content) is not None:
+        llm_cache.set(key, content)
+    return content
+
+# Потоковая выдача ответа нейросети в чат (server-sent events)
+CHAT_ERROR_TEXT = "Чёрт- побери, связь барахлит... Попробуй позже."
+
+def openrouter_stream(api_key, model, prompt, temperature=0.9, timeout=(10, 60)):
+    """Запрашиваем ответ OpenRouter с stream: true и отдаём его кусками по мере генерации.
+    timeout — (подключение, ожидание следующего куска) в секундах."""
+    response = http_session.post(
+        OPENROUTER_URL,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        },
+        json={
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+            "stream": True
+        },
+        stream=True,
+        timeout=timeout
+    )
+    with response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            # Строки-комментарии (": OPENROUTER PROCESSING") и пустые пропускаем
+            if not line.startswith(b'data:'):
+                continue
+            data = line[5:].strip()
+            if data == b'[DONE]':
+                break
+            chunk = json.loads(data)
+            if 'error' in chunk:
+                raise RuntimeError(chunk['error'])
+            choices = chunk.get('choices') or [{}]
+            delta = (choices[0].get('delta') or {}).get('content')
+            if delta:
+                yield delta
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def stream_chat_response(chunks):
+    """Превращаем поток кусков ответа в text/event-stream для браузера"""
+    def events():
+        try:
+            for delta in chunks:
+                yield sse_event({'delta': delta})
+            yield sse_event({}, event='done')
+        except Exception as e:
+            print(f"Chat stream error: {e}")
+            yield sse_event({'response': CHAT_ERROR_TEXT}, event='error')
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        # Отключаем буферизацию в прокси, иначе куски придут одним блоком
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 def get_treasure_info(lat, lon, radius=5):
     """Получаем информацию о возможных кладах в регионе через нейросеть"""
@@ -152,16 +1927,19 @@ def get_treasure_info(lat, lon, radius=5):
     MODEL = "deepseek/deepseek-r1:free"
 
     # Сначала получаем название местности
-    geolocator = Nominatim(user_agent="treasure_app", ssl_context=ssl_context)
-    location = geolocator.reverse(f"{lat}, {lon}", language='ru')
-    location_name = location.address if location else "этом районе"
+    address = reverse_geocode(lat, lon)
+    location_name = address if address else "этом районе"
 
     # Парсим сайты
-    parsed_info = parse_clad_sites(location_name.split(',')[0])
+    parsed_info = collect_clad_posts(location_name.split(',')[0])
+
+    # В запрос идут координаты узла сетки: клики по соседним точкам дают
+    # одинаковый запрос и берут ответ из кеша
+    grid_lat, grid_lon = quantize_coords(lat, lon)
 
     prompt = f"""
     Ты — кладоискатель со стажем! Отвечай только на вопросы, связанные с кладоискательством.
-    Проанализируй регион {location_name} (координаты: {lat}, {lon}, радиус {radius} км) как эксперт:
+    Проанализируй регион {location_name} (координаты: {grid_lat}, {grid_lon}, радиус {radius} км) как эксперт:
 
     1. Историческая справка (коротко, только факты):
        - Какие народы здесь жили?
@@ -179,28 +1957,8 @@ def get_treasure_info(lat, lon, radius=5):
     Если данных действительно нет, скажи честно — не придумывай.
     """
 
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    data = {
-        "model": MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.8
-    }
-
     try:
-        with Session() as session:
-            response = session.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
-            return result['choices'][0]['message']['content']
+        return openrouter_chat(API_KEY, MODEL, prompt, temperature=0.8, location=(lat, lon))
     except Exception as e:
         print(f"AI API error: {e}")
         return "Не удалось получить информацию. Попробуйте позже."
@@ -208,14 +1966,14 @@ def get_treasure_info(lat, lon, radius=5):
 def get_historical_data(lat, lon):
     """Получаем исторические данные о местности"""
     # Получаем название местности
-    geolocator = Nominatim(user_agent="treasure_app", ssl_context=ssl_context)
-    location = geolocator.reverse(f"{lat}, {lon}", language='ru')
-    location_name = location.address.split(',')[0] if location else "этом районе"
+    address = reverse_geocode(lat, lon)
+    location_name = address.split(',')[0] if address else "этом районе"
 
-    # Получаем данные из разных источников
-    wikipedia_text = get_wikipedia_data(location_name)
-    privolge_text = get_privolge_data(location_name)
-    etomesto_text = get_etomesto_data(location_name)
+    # Получаем данные из разных источников одновременно
+    sources = collect_history_sources(location_name, lat, lon)
+    wikipedia_text = sources['wikipedia']
+    privolge_text = sources['privolge']
+    etomesto_text = sources['etomesto']
 
     # Объединяем информацию
     combined_text = f"""
@@ -232,154 +1990,480 @@ def get_historical_data(lat, lon):
     """
 
     # Анализируем информацию с помощью нейросети
-    analysis = analyze_with_ai(combined_text)
+    analysis = analyze_with_ai(combined_text, location=(lat, lon))
 
     return analysis
 
-def get_wikipedia_data(location_name):
-    """Получаем данные с Википедии по всем регионам"""
-    try:
-        base_url = "https://ru.wikipedia.org"
-        search_url = f"{base_url}/w/index.php?search={location_name}"
-
-        response = requests.get(search_url, timeout=20)
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Ищем все ссылки на статьи, связанные с этим регионом
-        links = []
-        for link in soup.select('div.mw-search-result-heading a'):
-            href = link.get('href')
-            if href and not href.startswith('#'):
-                links.append(urljoin(base_url, href))
-
-        # Также проверяем категории
-        for cat in soup.select('div.mw-search-results li a[href^="/wiki/Category:"]'):
-            href = cat.get('href')
-            if href:
-                links.append(urljoin(base_url, href))
-
-        # Убираем дубликаты
-        links = list(set(links))
-
-        # Собираем текст со всех найденных страниц
-        all_text = []
-        for link in links[:5]:  # Ограничиваемся 5 страницами для скорости
-            try:
-                time.sleep(1)  # Задержка между запросами
-                page_response = requests.get(link, timeout=20)
-                page_soup = BeautifulSoup(page_response.text, 'html.parser')
-
-                # Получаем основной текст статьи
-                content = page_soup.find('div', {'id': 'mw-content-text'})
-                if content:
-                    # Удаляем таблицы и боковые панели
-                    for element in content(['table', 'div.infobox', 'div.thumb']):
-                        element.decompose()
-
-                    text = content.get_text(separator=' ', strip=True)
-                    text = ' '.join(text.split())  # Удаляем лишние пробелы
-                    all_text.append(text[:2000])  # Ограничиваем длину текста
-            except Exception as e:
-                print(f"Error parsing Wikipedia page {link}: {e}")
-                continue
+def analyze_with_ai(text, location=None):
+    """Анализируем текст с помощью нейросети"""
+    API_KEY = "________"
+    MODEL = "deepseek/deepseek-r1:free"
 
-        return ' '.join(all_text)
-    except Exception as e:
-        print(f"Error getting Wikipedia data: {e}")
-        return ""
+    prompt = f"""
+    Ты — кладоискатель со стажем! Проанализируй следующие данные и выдели важную информацию о возможных местах для поиска кладов:
+
+    {text}
+
+    Ответ дай в формате HTML, без лишних вступлений. Будь конкретным и критичным.
+    Если данных действительно нет, скажи честно — не придумывай.
+    """
 
-def get_privolge_data(location_name):
-    """Получаем данные с сайта Privolge"""
     try:
-        url = "https://privolge.ru/ischeznuvshie-derevni/"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-        response = requests.get(url, headers=headers, timeout=20)
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Ищем все статьи, связанные с этим регионом
-        articles = []
-        for article in soup.find_all('article'):
-            if location_name.lower() in article.get_text().lower():
-                # Удаляем ненужные элементы
-                for element in article(['script', 'style', 'iframe', 'img']):
-                    element.decompose()
-
-                text = article.get_text(separator=' ', strip=True)
-                text = ' '.join(text.split())
-                articles.append(text[:2000])  # Ограничиваем длину текста
-
-        return ' '.join(articles)
+        return openrouter_chat(API_KEY, MODEL, prompt, temperature=0.8, location=location)
     except Exception as e:
-        print(f"Error getting Privolge data: {e}")
-        return ""
+        print(f"AI API error: {e}")
+        return "Не удалось получить информацию. Попробуйте позже."
 
-def get_etomesto_data(location_name):
-    """Получаем данные с сайта etomesto.ru"""
+# Совмещённый анализ: один запрос к нейросети со всеми источниками вместо двух
+# (get_treasure_info и analyze_with_ai), ответ разбирается на обе панели
+COMBINED_ANALYSIS = os.environ.get('COMBINED_ANALYSIS', '0') == '1'
+
+def parse_analysis_sections(content):
+    """Достаём JSON-объект с разделами из ответа модели (допускаем обёртку ```json)"""
+    start = content.find('{')
+    end = content.rfind('}')
+    if start == -1 or end <= start:
+        return None
     try:
-        url = f"https://www.etomesto.ru/search/?query={location_name}"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-        response = requests.get(url, headers=headers, timeout=20)
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Ищем информацию о картах
-        maps_info = []
-        for item in soup.select('div.search-item'):
-            title = item.select_one('h3 a')
-            if title and location_name.lower() in title.get_text().lower():
-                desc = item.select_one('div.search-item-desc')
-                if desc:
-                    text = desc.get_text(separator=' ', strip=True)
-                    text = ' '.join(text.split())
-                    maps_info.append(text[:1000])  # Ограничиваем длину текста
-
-        return ' '.join(maps_info)
-    except Exception as e:
-        print(f"Error getting etomesto data: {e}")
-        return ""
+        sections = json.loads(content[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(sections, dict):
+        return None
+    return sections
 
-def analyze_with_ai(text):
-    """Анализируем текст с помощью нейросети"""
+def get_combined_analysis(lat, lon, radius=5):
+    """Анализируем местность одним запросом, результат — тексты для обеих панелей"""
     API_KEY = "________"
     MODEL = "deepseek/deepseek-r1:free"
 
+    address = reverse_geocode(lat, lon)
+    location_name = address if address else "этом районе"
+    short_name = location_name.split(',')[0]
+
+    try:
+        parsed_info, sources = run_async(
+            scrape_region_async(short_name, lat, lon), timeout=SCRAPE_TIMEOUT + 1
+        )
+    except Exception as e:
+        print(f"Region scraping error: {e!r}")
+        parsed_info, sources = [], {'wikipedia': "", 'privolge': "", 'etomesto': ""}
+
+    grid_lat, grid_lon = quantize_coords(lat, lon)
     prompt = f"""
-    Ты — кладоискатель со стажем! Проанализируй следующие данные и выдели важную информацию о возможных местах для поиска кладов:
+    Ты — кладоискатель со стажем! Отвечай только на вопросы, связанные с кладоискательством.
+    Проанализируй регион {location_name} (координаты: {grid_lat}, {grid_lon}, радиус {radius} км) как эксперт.
 
-    {text}
+    Данные с тематических сайтов:
+    {parsed_info if parsed_info else "Нет данных с тематических сайтов"}
 
-    Ответ дай в формате HTML, без лишних вступлений. Будь конкретным и критичным.
-    Если данных действительно нет, скажи честно — не придумывай.
+    Википедия:
+    {sources['wikipedia'] if sources['wikipedia'] else "Нет данных из Википедии"}
+
+    Privolge (исчезнувшие деревни):
+    {sources['privolge'] if sources['privolge'] else "Нет данных с Privolge"}
+
+    Etomesto (исторические карты):
+    {sources['etomesto'] if sources['etomesto'] else "Нет данных с Etomesto"}
+
+    Ответь одним JSON-объектом без пояснений вокруг, с двумя строковыми полями в формате HTML:
+    "treasure_info" — 1) историческая справка (какие народы жили, значимые события, где могли
+    прятать ценности), 2) 3-4 конкретных совета, где и как искать, 3) выводы по данным тематических сайтов;
+    "historical_data" — важное из исторических данных (Википедия, Privolge, Etomesto) о возможных
+    местах для поиска кладов.
+    Будь конкретным и критичным. Если данных действительно нет, скажи честно — не придумывай.
     """
 
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
+    fallback = {
+        'treasure_info': "Не удалось получить информацию. Попробуйте позже.",
+        'historical_data': "Не удалось получить информацию. Попробуйте позже."
+    }
+    try:
+        # Ответ без JSON-объекта в кеш не кладём, чтобы следующий запрос спросил модель заново
+        content = openrouter_chat(
+            API_KEY, MODEL, prompt, temperature=0.8, location=(lat, lon), timeout=40, json_mode=True,
+            validate=parse_analysis_sections
+        )
+    except Exception as e:
+        print(f"AI API error: {e}")
+        return fallback
+
+    sections = parse_analysis_sections(content)
+    if sections is None:
+        # Модель ответила не JSON — показываем ответ целиком в панели кладов
+        print("Combined analysis: response is not a JSON object")
+        return {'treasure_info': content, 'historical_data': fallback['historical_data']}
+    return {
+        'treasure_info': sections.get('treasure_info') or fallback['treasure_info'],
+        'historical_data': sections.get('historical_data') or fallback['historical_data']
     }
 
-    data = {
-        "model": MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.8
+# Пул потоков для параллельного сбора данных о точке
+enrichment_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='enrichment')
+
+# Дедлайны источников в секундах (отсчитываются от общего старта)
+ENRICHMENT_DEADLINES = {
+    'treasure_info': 45,
+    'weather': 10,
+    'historical_data': 60,
+    'combined_analysis': 60
+}
+DEFAULT_ENRICHMENT_DEADLINE = 30
+
+# Заглушки для источников, которые не успели ответить
+TREASURE_INFO_TIMEOUT_TEXT = "Копатель думает слишком долго. Обновите страницу чуть позже."
+HISTORICAL_DATA_TIMEOUT_TEXT = "Архивы не ответили вовремя. Обновите страницу чуть позже."
+
+def fan_out(tasks):
+    """Запускаем независимые источники параллельно и собираем то, что успело прийти.
+
+    tasks — словарь {имя: (функция, аргументы, запасное значение)}.
+    Источник, не уложившийся в свой дедлайн или упавший с ошибкой,
+    получает запасное значение, и страница отрисовывается с тем, что есть.
+    """
+    started = time.monotonic()
+    futures = {
+        name: enrichment_executor.submit(func, *args)
+        for name, (func, args, _) in tasks.items()
     }
 
+    results = {}
+    for name, future in futures.items():
+        fallback = tasks[name][2]
+        deadline = ENRICHMENT_DEADLINES.get(name, DEFAULT_ENRICHMENT_DEADLINE)
+        remaining = max(0, started + deadline - time.monotonic())
+        try:
+            results[name] = future.result(timeout=remaining)
+        except FuturesTimeout:
+            # Поток доработает в фоне, но ждать его мы больше не будем
+            future.cancel()
+            print(f"Enrichment source {name} timed out after {deadline}s")
+            results[name] = fallback
+        except Exception as e:
+            print(f"Enrichment source {name} error: {e}")
+            results[name] = fallback
+
+    return results
+
+def enrich_point(lat, lon):
+    """Собираем данные для панелей точки: клады, погоду и историю.
+
+    Одновременные запросы по одной ячейке сетки (например, по общей ссылке)
+    ждут один общий сбор вместо того, чтобы запускать свой.
+    """
+    key = ('enrich', quantize_coords(lat, lon), COMBINED_ANALYSIS)
+    return dict(singleflight.do(key, _enrich_point, lat, lon))
+
+def _enrich_point(lat, lon):
+    if COMBINED_ANALYSIS:
+        results = fan_out({
+            'combined_analysis': (get_combined_analysis, (lat, lon), None),
+            'weather': (get_weather, (lat, lon), None)
+        })
+        analysis = results.pop('combined_analysis') or {
+            'treasure_info': TREASURE_INFO_TIMEOUT_TEXT,
+            'historical_data': HISTORICAL_DATA_TIMEOUT_TEXT
+        }
+        results.update(analysis)
+        return results
+
+    # Источники независимы, поэтому опрашиваем их одновременно
+    return fan_out({
+        'treasure_info': (get_treasure_info, (lat, lon), TREASURE_INFO_TIMEOUT_TEXT),
+        'weather': (get_weather, (lat, lon), None),
+        'historical_data': (get_historical_data, (lat, lon), HISTORICAL_DATA_TIMEOUT_TEXT)
+    })
+
+# Фоновые задания анализа точки. Страница с картой отдаётся сразу, а клады,
+# погода и история считаются в пуле потоков. Состояние задания лежит в общем
+# SQLite-кеше, поэтому /jobs/<id> может ответить любой воркер.
+ENRICHMENT_JOBS = os.environ.get('ENRICHMENT_JOBS', '0') == '1'
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 8))
+JOB_TTL = 3600
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+job_store = SqliteCache('jobs', ttl=JOB_TTL, max_entries=10000)
+
+def submit_enrichment_job(lat, lon):
+    """Ставим анализ точки в очередь и возвращаем id задания"""
+    job_id = uuid.uuid4().hex
+    job_store.set(job_id, {'status': 'pending', 'created_at': time.time()})
+    job_executor.submit(_run_enrichment_job, job_id, lat, lon)
+    return job_id
+
+def _run_enrichment_job(job_id, lat, lon):
     try:
-        with Session() as session:
-            response = session.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
-            return result['choices'][0]['message']['content']
+        job_store.set(job_id, {'status': 'done', 'result': enrich_point(lat, lon)})
     except Exception as e:
-        print(f"AI API error: {e}")
-        return "Не удалось получить информацию. Попробуйте позже."
+        print(f"Enrichment job {job_id} error: {e}")
+        job_store.set(job_id, {
+            'status': 'error',
+            'result': {
+                'treasure_info': TREASURE_INFO_TIMEOUT_TEXT,
+                'weather': None,
+                'historical_data': HISTORICAL_DATA_TIMEOUT_TEXT
+            }
+        })
+
+# Вежливость к источникам: на каждый хост — свой «ведро токенов».
+# Запас burst позволяет сразу отправить пачку запросов, дальше не чаще rate в секунду.
+DEFAULT_HOST_RATE = float(os.environ.get('HOST_RATE_LIMIT', 1.0))
+DEFAULT_HOST_BURST = int(os.environ.get('HOST_RATE_BURST', 3))
+HOST_RATE_LIMITS = {
+    'ru.wikipedia.org': (5.0, 6)
+}
+
+class TokenBucket:
+    """Ограничитель частоты запросов, общий для потоков и цикла asyncio"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Забираем токен и возвращаем, сколько секунд подождать перед запросом.
+        Баланс может уходить в минус: так ожидающие выстраиваются в очередь."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+_host_buckets = {}
+_host_buckets_lock = threading.Lock()
+
+def host_rate_limiter(url):
+    """Возвращаем ограничитель для хоста из URL"""
+    host = urlparse(url).netloc
+    with _host_buckets_lock:
+        bucket = _host_buckets.get(host)
+        if bucket is None:
+            rate, burst = HOST_RATE_LIMITS.get(host, (DEFAULT_HOST_RATE, DEFAULT_HOST_BURST))
+            bucket = _host_buckets[host] = TokenBucket(rate, burst)
+    return bucket
+
+# Асинхронный конвейер парсинга: все загрузки страниц идут в одном фоновом
+# цикле asyncio, ограничены по числу соединений на хост и отменяются по таймауту
+ASYNC_HOST_CONCURRENCY = int(os.environ.get('ASYNC_HOST_CONCURRENCY', 4))
+ASYNC_FETCH_TIMEOUT = float(os.environ.get('ASYNC_FETCH_TIMEOUT', 20))
+SCRAPE_TIMEOUT = float(os.environ.get('SCRAPE_TIMEOUT', 15))
+SCRAPE_PARTIAL_MARGIN = 0.5  # Запас, с которым вложенный сбор отдаёт частичный результат
+
+_async_loop = None
+_async_loop_lock = threading.Lock()
+_host_semaphores = {}
+_aiohttp_session = None
+
+def _get_async_loop():
+    """Запускаем цикл asyncio в отдельном потоке при первом обращении"""
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            _async_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_async_loop.run_forever,
+                name='scraping-loop',
+                daemon=True
+            ).start()
+    return _async_loop
+
+def run_async(coro, timeout=None):
+    """Выполняем корутину в фоновом цикле и ждём результат из потока Flask.
+    По таймауту корутина отменяется, чтобы не держать соединения."""
+    future = asyncio.run_coroutine_threadsafe(coro, _get_async_loop())
+    try:
+        return future.result(timeout)
+    except FuturesTimeout:
+        future.cancel()
+        raise
+
+async def _get_aiohttp_session():
+    global _aiohttp_session
+    if _aiohttp_session is None or _aiohttp_session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=ASYNC_HOST_CONCURRENCY, ssl=ssl_context)
+        _aiohttp_session = aiohttp.ClientSession(connector=connector)
+    return _aiohttp_session
+
+async def fetch_async(url, headers=None, timeout=ASYNC_FETCH_TIMEOUT):
+    """Загружаем страницу, соблюдая частоту и число одновременных запросов к хосту.
+    Возвращаем (код ответа, текст, заголовки)."""
+    host = urlparse(url).netloc
+    if host not in _host_semaphores:
+        _host_semaphores[host] = asyncio.Semaphore(ASYNC_HOST_CONCURRENCY)
+
+    await host_rate_limiter(url).acquire_async()
+    async with _host_semaphores[host]:
+        if aiohttp is not None:
+            http = await _get_aiohttp_session()
+            request_timeout = aiohttp.ClientTimeout(total=timeout)
+            async with http.get(url, headers=headers, timeout=request_timeout) as response:
+                return response.status, await response.text(errors='replace'), response.headers
+
+        # Без aiohttp уводим запрос общей сессии в поток. Отмена освобождает
+        # корутину сразу, а сам поток завершится по таймауту запроса.
+        response = await asyncio.wait_for(
+            asyncio.to_thread(http_session.get, url, headers=headers, timeout=timeout),
+            timeout
+        )
+        return response.status_code, response.text, response.headers
+
+async def fetch_text_async(url, headers=None, timeout=ASYNC_FETCH_TIMEOUT):
+    _, text, _ = await fetch_async(url, headers, timeout)
+    return text
+
+# Загрузки страниц, идущие сейчас в цикле asyncio: {url: задача}
+_page_fetches = {}
+
+async def cached_get_async(url, headers=None):
+    """Асинхронный вариант cached_get; одновременные запросы одного URL делят одну загрузку"""
+    task = _page_fetches.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_cached_get_async(url, headers))
+        _page_fetches[url] = task
+        task.add_done_callback(lambda _: _page_fetches.pop(url, None))
+    # shield: отмена одного ожидающего не должна отменять общую загрузку
+    return await asyncio.shield(task)
+
+async def _cached_get_async(url, headers):
+    entry, fresh = await asyncio.to_thread(_fresh_page, url)
+    if fresh:
+        return entry['text']
+    try:
+        status, text, response_headers = await fetch_async(url, _conditional_headers(entry, headers))
+    except Exception as e:
+        return _stale_page(url, entry, e)
+    return await asyncio.to_thread(_remember_page, url, entry, status, text, response_headers)
+
+async def gather_within(coros, timeout, default=None):
+    """Запускаем корутины параллельно и собираем то, что успело за timeout.
+
+    coros — словарь {имя: корутина}. Упавшие и незавершённые задачи
+    получают значение default, незавершённые при этом отменяются.
+    """
+    tasks = {key: asyncio.ensure_future(coro) for key, coro in coros.items()}
+    if not tasks:
+        return {}
+
+    try:
+        done, _ = await asyncio.wait(tasks.values(), timeout=timeout)
+    finally:
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+
+    results = {}
+    for key, task in tasks.items():
+        if task not in done:
+            print(f"Scraping {key} timed out after {timeout}s")
+            results[key] = default
+        elif task.exception() is not None:
+            print(f"Scraping {key} error: {task.exception()}")
+            results[key] = default
+        else:
+            results[key] = task.result()
+    return results
+
+async def parse_clad_sites_async(location_name):
+    """Загружаем все тематические сайты одновременно"""
+    async def scrape_site(url, selector):
+        html = await cached_get_async(url)
+        # Разбор HTML занимает процессор, поэтому не блокируем им цикл
+        return await asyncio.to_thread(parse_clad_posts, html, url, selector, location_name)
+
+    pages = await gather_within(
+        {url: scrape_site(url, selector) for url, selector in CLAD_SITES},
+        SCRAPE_TIMEOUT,
+        default=[]
+    )
+
+    results = []
+    for url, _ in CLAD_SITES:
+        results.extend(pages[url])
+    return results[:3]  # Ограничиваемся 3 результатами
+
+async def get_wikipedia_data_async(location_name, lat=None, lon=None, deadline=None):
+    """deadline — момент по часам цикла, к которому вернуть уже загруженные страницы"""
+    loop = asyncio.get_running_loop()
+    if deadline is None:
+        deadline = loop.time() + SCRAPE_TIMEOUT
+    if WIKIPEDIA_BACKEND == 'api':
+        query = urlencode(wikipedia_api_params(location_name, lat, lon))
+        payload = await fetch_text_async(f"{WIKIPEDIA_API_URL}?{query}", headers=WIKIPEDIA_API_HEADERS)
+        return parse_wikipedia_extracts(json.loads(payload))
+
+    search_url = f"{WIKIPEDIA_BASE_URL}/w/index.php?search={location_name}"
+    links = await asyncio.to_thread(parse_wikipedia_search, await fetch_text_async(search_url))
+
+    async def scrape_page(link):
+        return await asyncio.to_thread(parse_wikipedia_page, await fetch_text_async(link))
+
+    # Таймер отсчитывается от общего старта, а не от загрузки поиска
+    pages = await gather_within(
+        {link: scrape_page(link) for link in links[:5]},  # Ограничиваемся 5 страницами
+        max(0, deadline - loop.time()),
+        default=""
+    )
+    return ' '.join(text for text in pages.values() if text)
+
+async def get_privolge_data_async(location_name, lat=None, lon=None):
+    if await asyncio.to_thread(village_index.has_villages):
+        return await asyncio.to_thread(village_index.describe, location_name, lat, lon)
+    html = await cached_get_async(PRIVOLGE_URL, headers=BROWSER_HEADERS)
+    return await asyncio.to_thread(parse_privolge_articles, html, location_name)
+
+async def get_etomesto_data_async(location_name):
+    url = ETOMESTO_SEARCH_URL.format(query=location_name)
+    html = await fetch_text_async(url, headers=BROWSER_HEADERS)
+    return await asyncio.to_thread(parse_etomesto_items, html, location_name)
+
+async def scrape_history_async(location_name, lat=None, lon=None):
+    """Собираем Википедию, Privolge и Etomesto одновременно"""
+    # Википедия сдаёт загруженные страницы чуть раньше общего таймаута,
+    # иначе он отменит её задачу целиком вместе с уже собранным
+    wikipedia_deadline = asyncio.get_running_loop().time() + SCRAPE_TIMEOUT - SCRAPE_PARTIAL_MARGIN
+    return await gather_within({
+        'wikipedia': get_wikipedia_data_async(location_name, lat, lon, wikipedia_deadline),
+        'privolge': get_privolge_data_async(location_name, lat, lon),
+        'etomesto': get_etomesto_data_async(location_name)
+    }, SCRAPE_TIMEOUT, default="")
+
+async def clad_posts_async(location_name):
+    """Посты о кладах: из индекса форумов, если он собран, иначе парсингом сайтов"""
+    if await asyncio.to_thread(forum_index.has_posts):
+        return await asyncio.to_thread(forum_index.search, location_name, 3)
+    return await parse_clad_sites_async(location_name)
+
+async def scrape_region_async(location_name, lat, lon):
+    """Форумы и исторические источники одним заходом для совмещённого анализа"""
+    clad_posts, sources = await asyncio.gather(
+        clad_posts_async(location_name),
+        scrape_history_async(location_name, lat, lon)
+    )
+    return clad_posts, sources
+
+def collect_clad_posts(location_name):
+    """Синхронная обёртка над асинхронным парсингом форумов для маршрутов Flask"""
+    try:
+        return run_async(clad_posts_async(location_name), timeout=SCRAPE_TIMEOUT + 1)
+    except Exception as e:
+        print(f"Clad sites scraping error: {e!r}")
+        return []
+
+def collect_history_sources(location_name, lat=None, lon=None):
+    """Синхронная обёртка над асинхронным сбором исторических данных"""
+    try:
+        return run_async(scrape_history_async(location_name, lat, lon), timeout=SCRAPE_TIMEOUT + 1)
+    except Exception as e:
+        print(f"History scraping error: {e!r}")
+        return {'wikipedia': "", 'privolge': "", 'etomesto': ""}
 
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -659,18 +2743,124 @@ HTML_TEMPLATE = '''
         let selectedPoints = [];
         let selectedRoutes = [];
 
-        function selectLocation(lat, lon) {
-            selectedPoints.push([lat, lon]);
-            fetch('/select_location', {
+        // Ищем объект карты Leaflet внутри iframe, который генерирует folium
+        function getLeafletMap() {
+            const frame = document.querySelector('#map iframe');
+            const win = frame && frame.contentWindow;
+            if (!win || !win.L) return null;
+            for (const key of Object.keys(win)) {
+                if (key.startsWith('map_') && win[key] instanceof win.L.Map) {
+                    return {win: win, L: win.L, map: win[key]};
+                }
+            }
+            return null;
+        }
+
+        function whenMapReady(callback, attempts = 50) {
+            const leaflet = getLeafletMap();
+            if (leaflet) {
+                callback(leaflet);
+            } else if (attempts > 0) {
+                setTimeout(() => whenMapReady(callback, attempts - 1), 100);
+            }
+        }
+
+        // Маркер в том же стиле, что рисует сервер
+        function treasureMarker(leaflet, lat, lon) {
+            const options = {};
+            if (leaflet.L.AwesomeMarkers) {
+                options.icon = leaflet.L.AwesomeMarkers.icon({icon: 'treasure-sign', markerColor: 'red', prefix: 'fa'});
+            }
+            return leaflet.L.marker([lat, lon], options).bindPopup(`Точка: ${lat}, ${lon}`);
+        }
+
+        function addMarkerToMap(lat, lon) {
+            const leaflet = getLeafletMap();
+            if (!leaflet) return;
+            // В режиме кластеров точку покажет перерисовка слоя кластеров:
+            // отдельный маркер поверх него задвоил бы её
+            refreshClusters(leaflet)
+            .catch(() => clusterLayer !== null)
+            .then(clustered => {
+                if (!clustered) {
+                    treasureMarker(leaflet, lat, lon).addTo(leaflet.map);
+                }
+            });
+        }
+
+        let clusterLayer = null;
+
+        // Догружаем точки видимой области; в режиме кластеров перерисовываем их.
+        // Промис разрешается признаком режима кластеров
+        function refreshClusters(leaflet) {
+            const bounds = leaflet.map.getBounds();
+            const bbox = [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()].join(',');
+            return fetch(`/api/points?bbox=${bbox}&zoom=${leaflet.map.getZoom()}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.clustered) return false;
+                if (!clusterLayer) {
+                    // Убираем кластеры, которые сервер нарисовал для стартового вида
+                    for (const key of Object.keys(leaflet.win)) {
+                        if (key.startsWith('feature_group_') && leaflet.win[key] instanceof leaflet.L.FeatureGroup) {
+                            leaflet.map.removeLayer(leaflet.win[key]);
+                        }
+                    }
+                    clusterLayer = leaflet.L.layerGroup().addTo(leaflet.map);
+                }
+                clusterLayer.clearLayers();
+                for (const [lat, lon, count] of data.clusters) {
+                    if (count === 1) {
+                        treasureMarker(leaflet, lat, lon).addTo(clusterLayer);
+                    } else {
+                        leaflet.L.circleMarker([lat, lon], {
+                            radius: Math.min(10 + 3 * Math.log2(count), 30),
+                            color: '#8B4513',
+                            fillColor: '#F4A460',
+                            fillOpacity: 0.8,
+                            // Клик по кластеру приближает его и не доходит до карты
+                            bubblingMouseEvents: false
+                        })
+                        .bindTooltip(`Находок: ${count}`)
+                        .on('click', () => leaflet.map.setView([lat, lon], leaflet.map.getZoom() + 2))
+                        .addTo(clusterLayer);
+                    }
+                }
+                return true;
+            });
+        }
+
+        function drawRoute(route) {
+            const leaflet = getLeafletMap();
+            if (!leaflet || !route.length) return;
+            leaflet.L.polyline(route, {color: 'blue', weight: 2.5, opacity: 1}).addTo(leaflet.map);
+        }
+
+        // Сохраняем точку через JSON API и дорисовываем маркер без перезагрузки страницы
+        function addPoint(lat, lon) {
+            return fetch('/api/points', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'Content-Type': 'application/json',
                 },
-                body: `lat=${lat}&lon=${lon}`
-            }).then(response => {
-                if (response.ok) {
-                    window.location.href = `/center_map?lat=${lat}&lon=${lon}`;
+                body: JSON.stringify({lat: lat, lon: lon})
+            })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Point not saved: ${response.status}`);
                 }
+                return response.json();
+            })
+            .then(data => {
+                selectedPoints.push(data.point);
+                addMarkerToMap(data.point[0], data.point[1]);
+                return data.point;
+            });
+        }
+
+        function selectLocation(lat, lon) {
+            addPoint(lat, lon).then(() => {
+                window.location.href = `/center_map?lat=${lat}&lon=${lon}`;
             });
         }
 
@@ -702,25 +2892,73 @@ HTML_TEMPLATE = '''
             // Прокручиваем чат вниз
             chatContainer.scrollTop = chatContainer.scrollHeight;
 
-            // Отправляем запрос к серверу
+            // Сообщение бота появляется сразу и дописывается по мере генерации
+            const botDiv = document.createElement('div');
+            botDiv.className = 'chat-message bot-message';
+            botDiv.textContent = 'Копатель думает...';
+            chatContainer.appendChild(botDiv);
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+
+            function showReply(html) {
+                botDiv.innerHTML = html;
+                chatContainer.scrollTop = chatContainer.scrollHeight;
+            }
+
+            // Отправляем запрос к серверу, ответ приходит потоком (server-sent events)
             fetch('/chat', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/x-www-form-urlencoded',
+                    'Accept': 'text/event-stream',
                 },
                 body: `message=${encodeURIComponent(message)}`
             })
-            .then(response => response.json())
-            .then(data => {
-                // Добавляем ответ бота
-                const botDiv = document.createElement('div');
-                botDiv.className = 'chat-message bot-message';
-                botDiv.innerHTML = data.response;
-                chatContainer.appendChild(botDiv);
+            .then(response => {
+                const type = response.headers.get('Content-Type') || '';
+                if (!type.includes('text/event-stream') || !response.body) {
+                    return response.json().then(data => showReply(data.response));
+                }
+                return readChatStream(response.body, showReply);
+            })
+            .catch(() => showReply('Чёрт- побери, связь барахлит... Попробуй позже.'));
+        }
 
-                // Прокручиваем чат вниз
-                chatContainer.scrollTop = chatContainer.scrollHeight;
-            });
+        function readChatStream(body, showReply) {
+            const reader = body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let text = '';
+
+            function handleEvent(raw) {
+                let event = 'message';
+                let data = '';
+                raw.split('\\n').forEach(line => {
+                    if (line.startsWith('event:')) event = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+                if (!data) return;
+                const payload = JSON.parse(data);
+                if (event === 'error') {
+                    showReply(payload.response);
+                } else if (payload.delta) {
+                    text += payload.delta;
+                    showReply(text);
+                }
+            }
+
+            function pump() {
+                return reader.read().then(({done, value}) => {
+                    if (done) return;
+                    buffer += decoder.decode(value, {stream: true});
+                    let boundary;
+                    while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                        handleEvent(buffer.slice(0, boundary));
+                        buffer = buffer.slice(boundary + 2);
+                    }
+                    return pump();
+                });
+            }
+            return pump();
         }
 
         function saveRoute() {
@@ -743,13 +2981,68 @@ HTML_TEMPLATE = '''
             .then(data => {
                 if (data.route) {
                     selectedPoints = data.route;
+                    // Рисуем загруженный маршрут прямо на открытой карте
+                    drawRoute(data.route);
                     alert('Маршрут загружен!');
-                    // Обновляем карту с загруженным маршрутом
-                    window.location.reload();
                 }
             });
         }
 
+        // Анализ точки считается в фоне: опрашиваем задание и заполняем панели по готовности
+        const enrichmentJob = {{ (job_id or none)|tojson }};
+
+        function renderEnrichment(result) {
+            const weatherPanel = document.getElementById('weather-panel');
+            if (result.weather) {
+                weatherPanel.innerHTML = `
+                    <div class="weather-info">
+                        <h3><i class="fas fa-thermometer-half"></i> Пиратский прогноз</h3>
+                        <div class="weather-temp"></div>
+                        <div class="weather-desc"></div>
+                        <div class="weather-time"></div>
+                    </div>`;
+                weatherPanel.querySelector('.weather-temp').textContent = `${result.weather.temp}°C`;
+                weatherPanel.querySelector('.weather-desc').textContent = result.weather.description;
+                weatherPanel.querySelector('.weather-time').textContent = `Обновлено: ${result.weather.time}`;
+            }
+            const advice = document.querySelector('#treasure-panel .expert-advice');
+            if (advice) advice.innerHTML = result.treasure_info || '';
+            document.getElementById('historical-data-text').textContent = result.historical_data || '';
+        }
+
+        // Дольше не ждём: воркер с заданием мог погибнуть, а сеть — пропасть
+        const ENRICHMENT_POLL_LIMIT_MS = 120000;
+
+        function enrichmentFailed() {
+            renderEnrichment({
+                treasure_info: 'Копатель потерял записи. Обновите страницу.',
+                historical_data: 'Архивы не ответили. Обновите страницу.'
+            });
+        }
+
+        function pollEnrichmentJob(jobId, delay, startedAt = Date.now()) {
+            const retry = wait => {
+                if (Date.now() - startedAt + wait > ENRICHMENT_POLL_LIMIT_MS) {
+                    enrichmentFailed();
+                    return;
+                }
+                setTimeout(() => pollEnrichmentJob(jobId, Math.min(wait * 1.5, 5000), startedAt), wait);
+            };
+
+            fetch(`/jobs/${jobId}`)
+            .then(response => response.json())
+            .then(job => {
+                if (job.status === 'pending') {
+                    retry(delay);
+                } else if (job.result) {
+                    renderEnrichment(job.result);
+                } else {
+                    enrichmentFailed();
+                }
+            })
+            .catch(() => retry(5000));
+        }
+
         function shareOnTelegram() {
             const message = encodeURIComponent("Посмотрите мой маршрут поиска кладов!");
             window.open(`https://t.me/share/url?url=${encodeURIComponent(window.location.href)}&text=${message}`, '_blank');
@@ -803,6 +3096,15 @@ HTML_TEMPLATE = '''
                     sendMessage();
                 }
             });
+
+            // При сдвиге карты перерисовываем кластеры видимой области
+            whenMapReady(leaflet => {
+                leaflet.map.on('moveend', () => refreshClusters(leaflet));
+            });
+
+            if (enrichmentJob) {
+                pollEnrichmentJob(enrichmentJob, 1000);
+            }
         });
 
         document.addEventListener('click', function(event) {
@@ -816,7 +3118,7 @@ HTML_TEMPLATE = '''
 </head>
 <body>
     <div id="map">
-        {{ m._repr_html_()|safe }}
+        {{ map_html|safe }}
     </div>
     <div id="sidebar">
         <h2><i class="fas fa-skull-crossbones"></i> Карта старого копателя</h2>
@@ -843,6 +3145,7 @@ HTML_TEMPLATE = '''
         </div>
         {% endif %}
 
+        <div id="weather-panel">
         {% if weather %}
         <div class="weather-info">
             <h3><i class="fas fa-thermometer-half"></i> Пиратский прогноз</h3>
@@ -851,7 +3154,9 @@ HTML_TEMPLATE = '''
             <div class="weather-time">Обновлено: {{ weather.time }}</div>
         </div>
         {% endif %}
+        </div>
 
+        <div id="treasure-panel">
         {% if treasure_info %}
         <div class="treasure-info">
             <h3><i class="fas fa-coins"></i> Совет от копателя:</h3>
@@ -859,7 +3164,15 @@ HTML_TEMPLATE = '''
                 {{ treasure_info|safe }}
             </div>
         </div>
+        {% elif job_id %}
+        <div class="treasure-info">
+            <h3><i class="fas fa-coins"></i> Совет от копателя:</h3>
+            <div class="expert-advice">
+                <i class="fas fa-spinner fa-spin"></i> Копатель изучает местность...
+            </div>
+        </div>
         {% endif %}
+        </div>
 
         <div class="route-actions">
             <button onclick="saveRoute()"><i class="fas fa-save"></i> Сохранить маршрут</button>
@@ -868,7 +3181,7 @@ HTML_TEMPLATE = '''
 
         <div class="historical-data">
             <h3><i class="fas fa-history"></i> Исторические данные</h3>
-            <p>{{ historical_data }}</p>
+            <p id="historical-data-text">{% if job_id %}<i class="fas fa-spinner fa-spin"></i> Поднимаем архивы...{% else %}{{ historical_data }}{% endif %}</p>
         </div>
 
         <div class="social-share">
@@ -912,9 +3225,8 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
-# Глобальная переменная для хранения точек (в реальном приложении используйте БД)
-selected_points = []
-selected_routes = []
+# Точки находок: общее постоянное хранилище и локальный индекс, маршрут — в point_storage
+selected_points = SharedPoints(point_storage)
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -923,7 +3235,7 @@ def index():
     old_map = session.get('old_map', False)
     return render_template_string(
         HTML_TEMPLATE,
-        m=create_map(lat, lon, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+        map_html=render_map(lat, lon, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
         query=request.form.get('query', ''),
         map_layer=map_layer,
         old_map=old_map
@@ -938,7 +3250,7 @@ def search_location_route():
     if not query:
         return render_template_string(
             HTML_TEMPLATE,
-            m=create_map(53.1959, 50.1002, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+            map_html=render_map(53.1959, 50.1002, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
             error="Эй, где будем искать-то? Введи название места!",
             query=query,
             map_layer=map_layer,
@@ -949,7 +3261,7 @@ def search_location_route():
     if locations:
         return render_template_string(
             HTML_TEMPLATE,
-            m=create_map(53.1959, 50.1002, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+            map_html=render_map(53.1959, 50.1002, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
             locations=locations,
             query=query,
             map_layer=map_layer,
@@ -958,7 +3270,7 @@ def search_location_route():
 
     return render_template_string(
         HTML_TEMPLATE,
-        m=create_map(53.1959, 50.1002, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+        map_html=render_map(53.1959, 50.1002, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
         error="Ничего не нашел. Может, опечатка? Или место слишком засекречено?",
         query=query,
         map_layer=map_layer,
@@ -972,27 +3284,171 @@ def select_location():
     selected_points.append((lat, lon))
     return '', 200
 
+def api_points_in_bbox(bbox):
+    """Точки видимой области; при большом их числе — кластеры для текущего масштаба"""
+    try:
+        south, west, north, east = (float(v) for v in bbox.split(','))
+        zoom = int(request.args.get('zoom', 15))
+    except ValueError:
+        return jsonify({'error': 'bbox должен быть в формате юг,запад,север,восток'}), 400
+
+    visible = points_in_bbox(selected_points, south, west, north, east)
+    clustered = len(selected_points) > MARKER_CLUSTER_THRESHOLD
+    if clustered:
+        items = cluster_points(visible, zoom)
+    else:
+        items = [(lat, lon, 1) for lat, lon in visible]
+    return jsonify({
+        'clustered': clustered,
+        'clusters': [[c_lat, c_lon, count] for c_lat, c_lon, count in items]
+    })
+
+def _parse_point(data):
+    """Достаём координаты точки из JSON или формы, None — если они некорректны"""
+    try:
+        return float(data.get('lat')), float(data.get('lon'))
+    except (TypeError, ValueError):
+        return None
+
+def _parse_route(route):
+    """Проверяем маршрут — список пар координат; None, если он некорректен"""
+    if not isinstance(route, list):
+        return None
+    points = [
+        _parse_point({'lat': p[0], 'lon': p[1]})
+        if isinstance(p, (list, tuple)) and len(p) == 2 else None
+        for p in route
+    ]
+    if None in points:
+        return None
+    return [list(p) for p in points]
+
+@app.route('/api/points', methods=['GET'])
+def api_points():
+    bbox = request.args.get('bbox')
+    if bbox:
+        return api_points_in_bbox(bbox)
+    return Response(_points_json(), mimetype='application/json')
+
+def _points_json():
+    """Отдаём точки потоком прямо из столбцов хранилища"""
+    route = json.dumps(point_storage.get_route())
+    points = selected_points.iter_json()
+    yield '{"points": '
+    yield from points
+    yield ', "routes": ' + route + '}'
+
+@app.route('/api/points.bin', methods=['GET'])
+def api_points_binary():
+    """Координаты одним бинарным блоком: столбец широт, затем столбец долгот.
+
+    Браузер читает их через Float64Array, Float32Array или Int32Array
+    (для fixed — делить на 1e7) в зависимости от X-Point-Encoding.
+    """
+    lats, lons = selected_points.column_bytes()
+    response = Response(iter([lats, lons]), mimetype='application/octet-stream')
+    response.headers['X-Point-Encoding'] = selected_points.encoding
+    response.headers['Content-Length'] = str(len(lats) + len(lons))
+    return response
+
+@app.route('/api/points', methods=['POST'])
+def api_add_point():
+    point = _parse_point(request.get_json(silent=True) or request.form)
+    if point is None:
+        return jsonify({'error': 'Нужны числовые lat и lon'}), 400
+    selected_points.append(point)
+    return jsonify({'point': list(point), 'count': len(selected_points)}), 201
+
+@app.route('/api/points/nearby', methods=['GET'])
+def api_points_nearby():
+    center = _parse_point(request.args)
+    if center is None:
+        return jsonify({'error': 'Нужны числовые lat и lon'}), 400
+    radius_km = request.args.get('radius_km', type=float)
+    k = max(1, min(request.args.get('k', 10, type=int), 1000))
+
+    if radius_km is not None:
+        found = selected_points.radius(center[0], center[1], radius_km)[:k]
+    else:
+        found = selected_points.nearest(center[0], center[1], k)
+    return jsonify({
+        'points': [
+            {'lat': lat, 'lon': lon, 'distance_km': round(distance, 3)}
+            for distance, (lat, lon) in found
+        ]
+    })
+
+@app.route('/api/villages/nearby', methods=['GET'])
+def api_villages_nearby():
+    center = _parse_point(request.args)
+    if center is None:
+        return jsonify({'error': 'Нужны числовые lat и lon'}), 400
+    radius_km = max(0.0, min(request.args.get('radius_km', 10, type=float), 200))
+    limit = max(1, min(request.args.get('limit', 50, type=int), 1000))
+
+    found = village_index.nearby(center[0], center[1], radius_km, limit)
+    return jsonify({
+        'villages': [
+            {
+                'name': village['name'],
+                'lat': village['lat'],
+                'lon': village['lon'],
+                'distance_km': round(distance, 3)
+            }
+            for distance, village in found
+        ]
+    })
+
+@app.route('/api/routes', methods=['GET'])
+def api_routes():
+    return jsonify({'route': point_storage.get_route()})
+
+@app.route('/api/routes', methods=['POST'])
+def api_set_route():
+    data = request.get_json(silent=True) or {}
+    route = data.get('route')
+    if not isinstance(route, list):
+        return jsonify({'error': 'Нужен маршрут в виде списка точек'}), 400
+    saved_route = _parse_route(route)
+    if saved_route is None:
+        return jsonify({'error': 'Некорректные точки маршрута'}), 400
+    point_storage.set_route(saved_route)
+    return jsonify({'route': saved_route}), 200
+
 @app.route('/center_map', methods=['GET'])
 def center_map():
     lat = float(request.args.get('lat'))
     lon = float(request.args.get('lon'))
     map_layer = session.get('map_layer', 'satellite')
     old_map = session.get('old_map', False)
-    treasure_info = get_treasure_info(lat, lon)
-    weather = get_weather(lat, lon)
-    historical_data = get_historical_data(lat, lon)
+
+    job_id = None
+    if ENRICHMENT_JOBS:
+        # Отдаём карту сразу, панели заполнятся из /jobs/<id>
+        job_id = submit_enrichment_job(lat, lon)
+        results = {'treasure_info': None, 'weather': None, 'historical_data': None}
+    else:
+        results = enrich_point(lat, lon)
 
     return render_template_string(
         HTML_TEMPLATE,
-        m=create_map(lat, lon, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+        map_html=render_map(lat, lon, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
         query=request.args.get('query', ''),
-        treasure_info=treasure_info,
-        weather=weather,
-        historical_data=historical_data,
+        treasure_info=results['treasure_info'],
+        weather=results['weather'],
+        historical_data=results['historical_data'],
+        job_id=job_id,
         map_layer=map_layer,
         old_map=old_map
     )
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'status': 'unknown'}), 404
+    return jsonify(job)
+
 @app.route('/chat', methods=['POST'])
 def chat():
     message = request.form.get('message', '').strip()
@@ -1009,6 +3465,10 @@ def chat():
 
     Отвечай кратко (5-6 предложения), по делу. Если вопрос не о кладах — откажись отвечать."""
 
+    # Браузер, готовый читать поток, получает ответ по мере генерации
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return stream_chat_response(openrouter_stream(API_KEY, MODEL, prompt, temperature=0.9))
+
     headers = {
         "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json"
@@ -1021,33 +3481,36 @@ def chat():
     }
 
     try:
-        with Session() as session:
-            response = session.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
-            response_text = result['choices'][0]['message']['content']
-            return jsonify({"response": response_text})
+        response = http_session.post(
+            "https://openrouter.ai/api/v1/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=30
+        )
+        response.raise_for_status()
+        result = response.json()
+        response_text = result['choices'][0]['message']['content']
+        return jsonify({"response": response_text})
     except Exception as e:
         print(f"Chat error: {e}")
         return jsonify({"response": "Чёрт- побери, связь барахлит... Попробуй позже."})
 
 @app.route('/save_route', methods=['POST'])
 def save_route():
-    route = request.form.get('route')
-    if route:
-        session['route'] = json.loads(route)
-        return '', 200
-    return '', 400
+    # Маршрут хранится в общем хранилище, а не в cookie сессии:
+    # его видят все воркеры и он переживает перезапуск
+    try:
+        route = _parse_route(json.loads(request.form.get('route') or 'null'))
+    except ValueError:
+        route = None
+    if route is None:
+        return '', 400
+    point_storage.set_route(route)
+    return '', 200
 
 @app.route('/load_route', methods=['GET'])
 def load_route():
-    route = session.get('route', [])
-    return jsonify({"route": route})
+    return jsonify({"route": point_storage.get_route()})
 
 @app.route('/change_map_layer', methods=['POST'])
 def change_map_layer():
@@ -1061,15 +3524,25 @@ def toggle_old_map():
     session['old_map'] = old_map
     return '', 200
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'geocode': geocode_cache.stats(),
+        'reverse_geocode': reverse_geocode_cache.stats(),
+        'map_render': map_render_cache.stats(),
+        'pages': page_cache.stats(),
+        'llm': llm_cache.stats(),
+        'singleflight': singleflight.stats()
+    })
+
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
 # Импортируем необходимые библиотеки
-from flask import Flask, render_template_string, request, jsonify, session  # Flask для создания веб-приложения
+from flask import Flask, render_template_string, request, jsonify, session, Response, stream_with_context  # Flask для создания веб-приложения
 import folium  # Для работы с картами
 from geopy.geocoders import Nominatim  # Для геокодирования
 import ssl  # Для работы с SSL
 import certifi  # Для SSL сертификатов
-from functools import lru_cache  # Для кеширования
 import requests  # Для выполнения HTTP-запросов
 from requests import Session  # Для сессий запросов
 from bs4 import BeautifulSoup  # Для парсинга HTML
@@ -1087,22 +3560,14 @@ app.secret_key = 'your_secret_key'  # Замените на ваш секрет
 # Фикс SSL проблем для geopy
 ssl_context = ssl.create_default_context(cafile=certifi.where())
 
-# Кешируем геокодирование для уменьшения запросов к 
-@lru_cache(maxsize=100)
+# Кешируем геокодирование для уменьшения запросов к API (общий постоянный кеш geocode_cache)
 def search_locations(query):
-    # Создаем экземпляр геокодера Nominatim
-    geolocator = Nominatim(
-        user_agent="map_application",
-        ssl_context=ssl_context,
-        timeout=20
-    )
     try:
-        # Ищем местоположения по запросу
-        locations = geolocator.geocode(query, country_codes='RU', exactly_one=False)
-        return locations if locations else []  # Возвращаем найденные местоположения или пустой список
+        # Справочник, кеш и Nominatim — в общем geocode_locations
+        return geocode_locations(query)  # Возвращаем найденные местоположения
     except Exception as e:
         print(f"Ошибка геокодирования: {e}")  # Выводим ошибку, если она есть
-        return []  # Возвращаем пустой список в случае ошибки
+        return []  # Возвращаем пустой список в случае ошибки (в кеш не кладём)
 
 # Создаем карту с заданными параметрами
 def create_map(lat, lon, points=None, routes=None, zoom_start=15, map_layer='satellite', old_map=False):
@@ -1131,8 +3596,11 @@ def create_map(lat, lon, points=None, routes=None, zoom_start=15, map_layer='sat
             control=True
         ).add_to(m)
 
+    # Слишком много точек — рисуем кластеры только для видимой области
+    if points and len(points) > MARKER_CLUSTER_THRESHOLD:
+        add_point_clusters(m, points, lat, lon, zoom_start)
     # Добавляем маркеры на карту, если есть точки
-    if points:
+    elif points:
         for point in points:
             folium.Marker(
                 location=[point[0], point[1]],
@@ -1154,7 +3622,7 @@ def get_weather(lat, lon):
     try:
         # Формируем URL для запроса погоды
         url = f"https://.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true"
-        response = requests.get(url, timeout=20)  # Выполняем запрос
+        response = http_session.get(url, timeout=20)  # Выполняем запрос
         data = response.json()  # Получаем данные в формате JSON
 
         # Проверяем, что данные содержат нужные поля
@@ -1188,55 +3656,25 @@ def get_weather(lat, lon):
         print(f"Ошибка  погоды: {e}")  # Выводим ошибку, если она есть
         return None  # Возвращаем None в случае ошибки
 
-# Парсим тематические сайты о кладах в указанном регионе
-def parse_clad_sites(location_name):
-    sites = [
-        ("http://samara-clad.ru/", "div.post-content"),
-        ("https://samarafishing.ru/board/index.php?topic=40553.0", "div.post"),
-        ("https://mdrussia.ru/topic/89888-samarskaja-oblast/", "div.msg")
-    ]
-
-    results = []
-
-    for url, selector in sites:
-        try:
-            response = requests.get(url, timeout=20)  # Выполняем запрос
-            soup = BeautifulSoup(response.text, 'html.parser')  # Парсим HTML
-            posts = soup.select(selector)  # Ищем посты по селектору
-
-            for post in posts[:3]:  # Берем первые 3 записи
-                text = post.get_text(separator=' ', strip=True)  # Получаем текст поста
-                if location_name.lower() in text.lower():  # Проверяем, содержится ли название местности в тексте
-                    # Очищаем текст от лишних пробелов и переносов
-                    text = ' '.join(text.split())
-                    results.append({
-                        'source': url,
-                        'text': text[:500] + '...' if len(text) > 500 else text  # Ограничиваем длину текста
-                    })
-                    if len(results) >= 3:  # Ограничиваемся 3 результатами
-                        break
-        except Exception as e:
-            print(f"Ошибка парсинга {url}: {e}")  # Выводим ошибку, если она есть
-            continue
-
-    return results  # Возвращаем результаты
-
 # Получаем информацию о возможных кладах в регионе через нейросеть
 def get_treasure_info(lat, lon, radius=5):
     API_KEY = "____________"
     MODEL = "deepseek/deepseek-r1:free"
 
     # Сначала получаем название местности
-    geolocator = Nominatim(user_agent="treasure_app", ssl_context=ssl_context)
-    location = geolocator.reverse(f"{lat}, {lon}", language='ru')
-    location_name = location.address if location else "этом районе"
+    address = reverse_geocode(lat, lon)
+    location_name = address if address else "этом районе"
 
     # Парсим сайты
-    parsed_info = parse_clad_sites(location_name.split(',')[0])
+    parsed_info = collect_clad_posts(location_name.split(',')[0])
+
+    # В запрос идут координаты узла сетки: клики по соседним точкам дают
+    # одинаковый запрос и берут ответ из кеша
+    grid_lat, grid_lon = quantize_coords(lat, lon)
 
     prompt = f"""
     Ты — кладоискатель со стажем! Отвечай только на вопросы, связанные с кладоискательством.
-    Проанализируй регион {location_name} (координаты: {lat}, {lon}, радиус {radius} км) как эксперт:
+    Проанализируй регион {location_name} (координаты: {grid_lat}, {grid_lon}, радиус {radius} км) как эксперт:
 
     1. Историческая справка (коротко, только факты):
        - Какие народы здесь жили?
@@ -1254,28 +3692,8 @@ def get_treasure_info(lat, lon, radius=5):
     Если данных действительно нет, скажи честно — не придумывай.
     """
 
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    data = {
-        "model": MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.8
-    }
-
     try:
-        with Session() as session:
-            response = session.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
-            return result['choices'][0]['message']['content']  # Возвращаем ответ от нейросети
+        return openrouter_chat(API_KEY, MODEL, prompt, temperature=0.8, location=(lat, lon))  # Ответ нейросети (из кеша, если регион уже разбирали)
     except Exception as e:
         print(f"Ошибка API нейросети: {e}")  # Выводим ошибку, если она есть
         return "Не удалось получить информацию. Попробуйте позже."  # Возвращаем сообщение об ошибке
@@ -1283,14 +3701,14 @@ def get_treasure_info(lat, lon, radius=5):
 # Получаем исторические данные о местности
 def get_historical_data(lat, lon):
     # Получаем название местности
-    geolocator = Nominatim(user_agent="treasure_app", ssl_context=ssl_context)
-    location = geolocator.reverse(f"{lat}, {lon}", language='ru')
-    location_name = location.address.split(',')[0] if location else "этом районе"
+    address = reverse_geocode(lat, lon)
+    location_name = address.split(',')[0] if address else "этом районе"
 
-    # Получаем данные из разных источников
-    wikipedia_text = get_wikipedia_data(location_name)
-    privolge_text = get_privolge_data(location_name)
-    etomesto_text = get_etomesto_data(location_name)
+    # Получаем данные из разных источников одновременно
+    sources = collect_history_sources(location_name, lat, lon)
+    wikipedia_text = sources['wikipedia']
+    privolge_text = sources['privolge']
+    etomesto_text = sources['etomesto']
 
     # Объединяем информацию
     combined_text = f"""
@@ -1307,117 +3725,12 @@ def get_historical_data(lat, lon):
     """
 
     # Анализируем информацию с помощью нейросети
-    analysis = analyze_with_ai(combined_text)
+    analysis = analyze_with_ai(combined_text, location=(lat, lon))
 
     return analysis  # Возвращаем анализ
 
-# Получаем данные с Википедии по всем регионам
-def get_wikipedia_data(location_name):
-    try:
-        base_url = "https://ru.wikipedia.org"
-        search_url = f"{base_url}/w/index.php?search={location_name}"
-
-        response = requests.get(search_url, timeout=20)  # Выполняем запрос
-        soup = BeautifulSoup(response.text, 'html.parser')  # Парсим HTML
-
-        # Ищем все ссылки на статьи, связанные с этим регионом
-        links = []
-        for link in soup.select('div.mw-search-result-heading a'):
-            href = link.get('href')
-            if href and not href.startswith('#'):
-                links.append(urljoin(base_url, href))
-
-        # Также проверяем категории
-        for cat in soup.select('div.mw-search-results li a[href^="/wiki/Category:"]'):
-            href = cat.get('href')
-            if href:
-                links.append(urljoin(base_url, href))
-
-        # Убираем дубликаты
-        links = list(set(links))
-
-        # Собираем текст со всех найденных страниц
-        all_text = []
-        for link in links[:5]:  # Ограничиваемся 5 страницами для скорости
-            try:
-                time.sleep(1)  # Задержка между запросами
-                page_response = requests.get(link, timeout=20)  # Выполняем запрос
-                page_soup = BeautifulSoup(page_response.text, 'html.parser')  # Парсим HTML
-
-                # Получаем основной текст статьи
-                content = page_soup.find('div', {'id': 'mw-content-text'})
-                if content:
-                    # Удаляем таблицы и боковые панели
-                    for element in content(['table', 'div.infobox', 'div.thumb']):
-                        element.decompose()
-
-                    text = content.get_text(separator=' ', strip=True)  # Получаем текст статьи
-                    text = ' '.join(text.split())  # Удаляем лишние пробелы
-                    all_text.append(text[:2000])  # Ограничиваем длину текста
-            except Exception as e:
-                print(f"Ошибка парсинга страницы Википедии {link}: {e}")  # Выводим ошибку, если она есть
-                continue
-
-        return ' '.join(all_text)  # Возвращаем собранный текст
-    except Exception as e:
-        print(f"Ошибка получения данных с Википедии: {e}")  # Выводим ошибку, если она есть
-        return ""  # Возвращаем пустую строку в случае ошибки
-
-# Получаем данные с сайта Privolge
-def get_privolge_data(location_name):
-    try:
-        url = "https://privolge.ru/ischeznuvshie-derevni/"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-        response = requests.get(url, headers=headers, timeout=20)  # Выполняем запрос
-        soup = BeautifulSoup(response.text, 'html.parser')  # Парсим HTML
-
-        # Ищем все статьи, связанные с этим регионом
-        articles = []
-        for article in soup.find_all('article'):
-            if location_name.lower() in article.get_text().lower():  # Проверяем, содержится ли название местности в тексте
-                # Удаляем ненужные элементы
-                for element in article(['script', 'style', 'iframe', 'img']):
-                    element.decompose()
-
-                text = article.get_text(separator=' ', strip=True)  # Получаем текст статьи
-                text = ' '.join(text.split())  # Удаляем лишние пробелы
-                articles.append(text[:2000])  # Ограничиваем длину текста
-
-        return ' '.join(articles)  # Возвращаем собранный текст
-    except Exception as e:
-        print(f"Ошибка получения данных с Privolge: {e}")  # Выводим ошибку, если она есть
-        return ""  # Возвращаем пустую строку в случае ошибки
-
-# Получаем данные с сайта etomesto.ru
-def get_etomesto_data(location_name):
-    try:
-        url = f"https://www.etomesto.ru/search/?query={location_name}"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-        response = requests.get(url, headers=headers, timeout=20)  # Выполняем запрос
-        soup = BeautifulSoup(response.text, 'html.parser')  # Парсим HTML
-
-        # Ищем информацию о картах
-        maps_info = []
-        for item in soup.select('div.search-item'):
-            title = item.select_one('h3 a')
-            if title and location_name.lower() in title.get_text().lower():  # Проверяем, содержится ли название местности в тексте
-                desc = item.select_one('div.search-item-desc')
-                if desc:
-                    text = desc.get_text(separator=' ', strip=True)  # Получаем текст описания
-                    text = ' '.join(text.split())  # Удаляем лишние пробелы
-                    maps_info.append(text[:1000])  # Ограничиваем длину текста
-
-        return ' '.join(maps_info)  # Возвращаем собранный текст
-    except Exception as e:
-        print(f"Ошибка получения данных с Etomesto: {e}")  # Выводим ошибку, если она есть
-        return ""  # Возвращаем пустую строку в случае ошибки
-
 # Анализируем текст с помощью нейросети
-def analyze_with_ai(text):
+def analyze_with_ai(text, location=None):
     API_KEY = "_____________"
     MODEL = "deepseek/deepseek-r1:free"
 
@@ -1430,28 +3743,8 @@ def analyze_with_ai(text):
     Если данных действительно нет, скажи честно — не придумывай.
     """
 
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    data = {
-        "model": MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.8
-    }
-
     try:
-        with Session() as session:
-            response = session.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
-            return result['choices'][0]['message']['content']  # Возвращаем ответ от нейросети
+        return openrouter_chat(API_KEY, MODEL, prompt, temperature=0.8, location=location)  # Ответ нейросети (из кеша, если регион уже разбирали)
     except Exception as e:
         print(f"Ошибка API нейросети: {e}")  # Выводим ошибку, если она есть
         return "Не удалось получить информацию. Попробуйте позже."  # Возвращаем сообщение об ошибке
@@ -1735,18 +4028,124 @@ HTML_TEMPLATE = '''
         let selectedPoints = [];
         let selectedRoutes = [];
 
-        function selectLocation(lat, lon) {
-            selectedPoints.push([lat, lon]);
-            fetch('/select_location', {
+        // Ищем объект карты Leaflet внутри iframe, который генерирует folium
+        function getLeafletMap() {
+            const frame = document.querySelector('#map iframe');
+            const win = frame && frame.contentWindow;
+            if (!win || !win.L) return null;
+            for (const key of Object.keys(win)) {
+                if (key.startsWith('map_') && win[key] instanceof win.L.Map) {
+                    return {win: win, L: win.L, map: win[key]};
+                }
+            }
+            return null;
+        }
+
+        function whenMapReady(callback, attempts = 50) {
+            const leaflet = getLeafletMap();
+            if (leaflet) {
+                callback(leaflet);
+            } else if (attempts > 0) {
+                setTimeout(() => whenMapReady(callback, attempts - 1), 100);
+            }
+        }
+
+        // Маркер в том же стиле, что рисует сервер
+        function treasureMarker(leaflet, lat, lon) {
+            const options = {};
+            if (leaflet.L.AwesomeMarkers) {
+                options.icon = leaflet.L.AwesomeMarkers.icon({icon: 'treasure-sign', markerColor: 'red', prefix: 'fa'});
+            }
+            return leaflet.L.marker([lat, lon], options).bindPopup(`Точка: ${lat}, ${lon}`);
+        }
+
+        function addMarkerToMap(lat, lon) {
+            const leaflet = getLeafletMap();
+            if (!leaflet) return;
+            // В режиме кластеров точку покажет перерисовка слоя кластеров:
+            // отдельный маркер поверх него задвоил бы её
+            refreshClusters(leaflet)
+            .catch(() => clusterLayer !== null)
+            .then(clustered => {
+                if (!clustered) {
+                    treasureMarker(leaflet, lat, lon).addTo(leaflet.map);
+                }
+            });
+        }
+
+        let clusterLayer = null;
+
+        // Догружаем точки видимой области; в режиме кластеров перерисовываем их.
+        // Промис разрешается признаком режима кластеров
+        function refreshClusters(leaflet) {
+            const bounds = leaflet.map.getBounds();
+            const bbox = [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()].join(',');
+            return fetch(`/api/points?bbox=${bbox}&zoom=${leaflet.map.getZoom()}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.clustered) return false;
+                if (!clusterLayer) {
+                    // Убираем кластеры, которые сервер нарисовал для стартового вида
+                    for (const key of Object.keys(leaflet.win)) {
+                        if (key.startsWith('feature_group_') && leaflet.win[key] instanceof leaflet.L.FeatureGroup) {
+                            leaflet.map.removeLayer(leaflet.win[key]);
+                        }
+                    }
+                    clusterLayer = leaflet.L.layerGroup().addTo(leaflet.map);
+                }
+                clusterLayer.clearLayers();
+                for (const [lat, lon, count] of data.clusters) {
+                    if (count === 1) {
+                        treasureMarker(leaflet, lat, lon).addTo(clusterLayer);
+                    } else {
+                        leaflet.L.circleMarker([lat, lon], {
+                            radius: Math.min(10 + 3 * Math.log2(count), 30),
+                            color: '#8B4513',
+                            fillColor: '#F4A460',
+                            fillOpacity: 0.8,
+                            // Клик по кластеру приближает его и не доходит до карты
+                            bubblingMouseEvents: false
+                        })
+                        .bindTooltip(`Находок: ${count}`)
+                        .on('click', () => leaflet.map.setView([lat, lon], leaflet.map.getZoom() + 2))
+                        .addTo(clusterLayer);
+                    }
+                }
+                return true;
+            });
+        }
+
+        function drawRoute(route) {
+            const leaflet = getLeafletMap();
+            if (!leaflet || !route.length) return;
+            leaflet.L.polyline(route, {color: 'blue', weight: 2.5, opacity: 1}).addTo(leaflet.map);
+        }
+
+        // Сохраняем точку через JSON API и дорисовываем маркер без перезагрузки страницы
+        function addPoint(lat, lon) {
+            return fetch('/api/points', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'Content-Type': 'application/json',
                 },
-                body: `lat=${lat}&lon=${lon}`
-            }).then(response => {
-                if (response.ok) {
-                    window.location.href = `/center_map?lat=${lat}&lon=${lon}`;
+                body: JSON.stringify({lat: lat, lon: lon})
+            })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Point not saved: ${response.status}`);
                 }
+                return response.json();
+            })
+            .then(data => {
+                selectedPoints.push(data.point);
+                addMarkerToMap(data.point[0], data.point[1]);
+                return data.point;
+            });
+        }
+
+        function selectLocation(lat, lon) {
+            addPoint(lat, lon).then(() => {
+                window.location.href = `/center_map?lat=${lat}&lon=${lon}`;
             });
         }
 
@@ -1778,25 +4177,73 @@ HTML_TEMPLATE = '''
             // Прокручиваем чат вниз
             chatContainer.scrollTop = chatContainer.scrollHeight;
 
-            // Отправляем запрос к серверу
+            // Сообщение бота появляется сразу и дописывается по мере генерации
+            const botDiv = document.createElement('div');
+            botDiv.className = 'chat-message bot-message';
+            botDiv.textContent = 'Копатель думает...';
+            chatContainer.appendChild(botDiv);
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+
+            function showReply(html) {
+                botDiv.innerHTML = html;
+                chatContainer.scrollTop = chatContainer.scrollHeight;
+            }
+
+            // Отправляем запрос к серверу, ответ приходит потоком (server-sent events)
             fetch('/chat', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/x-www-form-urlencoded',
+                    'Accept': 'text/event-stream',
                 },
                 body: `message=${encodeURIComponent(message)}`
             })
-            .then(response => response.json())
-            .then(data => {
-                // Добавляем ответ бота
-                const botDiv = document.createElement('div');
-                botDiv.className = 'chat-message bot-message';
-                botDiv.innerHTML = data.response;
-                chatContainer.appendChild(botDiv);
+            .then(response => {
+                const type = response.headers.get('Content-Type') || '';
+                if (!type.includes('text/event-stream') || !response.body) {
+                    return response.json().then(data => showReply(data.response));
+                }
+                return readChatStream(response.body, showReply);
+            })
+            .catch(() => showReply('Чёрт- побери, связь барахлит... Попробуй позже.'));
+        }
 
-                // Прокручиваем чат вниз
-                chatContainer.scrollTop = chatContainer.scrollHeight;
-            });
+        function readChatStream(body, showReply) {
+            const reader = body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let text = '';
+
+            function handleEvent(raw) {
+                let event = 'message';
+                let data = '';
+                raw.split('\\n').forEach(line => {
+                    if (line.startsWith('event:')) event = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+                if (!data) return;
+                const payload = JSON.parse(data);
+                if (event === 'error') {
+                    showReply(payload.response);
+                } else if (payload.delta) {
+                    text += payload.delta;
+                    showReply(text);
+                }
+            }
+
+            function pump() {
+                return reader.read().then(({done, value}) => {
+                    if (done) return;
+                    buffer += decoder.decode(value, {stream: true});
+                    let boundary;
+                    while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                        handleEvent(buffer.slice(0, boundary));
+                        buffer = buffer.slice(boundary + 2);
+                    }
+                    return pump();
+                });
+            }
+            return pump();
         }
 
         function saveRoute() {
@@ -1819,13 +4266,68 @@ HTML_TEMPLATE = '''
             .then(data => {
                 if (data.route) {
                     selectedPoints = data.route;
+                    // Рисуем загруженный маршрут прямо на открытой карте
+                    drawRoute(data.route);
                     alert('Маршрут загружен!');
-                    // Обновляем карту с загруженным маршрутом
-                    window.location.reload();
                 }
             });
         }
 
+        // Анализ точки считается в фоне: опрашиваем задание и заполняем панели по готовности
+        const enrichmentJob = {{ (job_id or none)|tojson }};
+
+        function renderEnrichment(result) {
+            const weatherPanel = document.getElementById('weather-panel');
+            if (result.weather) {
+                weatherPanel.innerHTML = `
+                    <div class="weather-info">
+                        <h3><i class="fas fa-thermometer-half"></i> Пиратский прогноз</h3>
+                        <div class="weather-temp"></div>
+                        <div class="weather-desc"></div>
+                        <div class="weather-time"></div>
+                    </div>`;
+                weatherPanel.querySelector('.weather-temp').textContent = `${result.weather.temp}°C`;
+                weatherPanel.querySelector('.weather-desc').textContent = result.weather.description;
+                weatherPanel.querySelector('.weather-time').textContent = `Обновлено: ${result.weather.time}`;
+            }
+            const advice = document.querySelector('#treasure-panel .expert-advice');
+            if (advice) advice.innerHTML = result.treasure_info || '';
+            document.getElementById('historical-data-text').textContent = result.historical_data || '';
+        }
+
+        // Дольше не ждём: воркер с заданием мог погибнуть, а сеть — пропасть
+        const ENRICHMENT_POLL_LIMIT_MS = 120000;
+
+        function enrichmentFailed() {
+            renderEnrichment({
+                treasure_info: 'Копатель потерял записи. Обновите страницу.',
+                historical_data: 'Архивы не ответили. Обновите страницу.'
+            });
+        }
+
+        function pollEnrichmentJob(jobId, delay, startedAt = Date.now()) {
+            const retry = wait => {
+                if (Date.now() - startedAt + wait > ENRICHMENT_POLL_LIMIT_MS) {
+                    enrichmentFailed();
+                    return;
+                }
+                setTimeout(() => pollEnrichmentJob(jobId, Math.min(wait * 1.5, 5000), startedAt), wait);
+            };
+
+            fetch(`/jobs/${jobId}`)
+            .then(response => response.json())
+            .then(job => {
+                if (job.status === 'pending') {
+                    retry(delay);
+                } else if (job.result) {
+                    renderEnrichment(job.result);
+                } else {
+                    enrichmentFailed();
+                }
+            })
+            .catch(() => retry(5000));
+        }
+
         function shareOnTelegram() {
             const message = encodeURIComponent("Посмотрите мой маршрут поиска кладов!");
             window.open(`https://t.me/share/url?url=${encodeURIComponent(window.location.href)}&text=${message}`, '_blank');
@@ -1879,6 +4381,15 @@ HTML_TEMPLATE = '''
                     sendMessage();
                 }
             });
+
+            // При сдвиге карты перерисовываем кластеры видимой области
+            whenMapReady(leaflet => {
+                leaflet.map.on('moveend', () => refreshClusters(leaflet));
+            });
+
+            if (enrichmentJob) {
+                pollEnrichmentJob(enrichmentJob, 1000);
+            }
         });
 
         document.addEventListener('click', function(event) {
@@ -1892,7 +4403,7 @@ HTML_TEMPLATE = '''
 </head>
 <body>
     <div id="map">
-        {{ m._repr_html_()|safe }}
+        {{ map_html|safe }}
     </div>
     <div id="sidebar">
         <h2><i class="fas fa-skull-crossbones"></i> Карта старого копателя</h2>
@@ -1919,6 +4430,7 @@ HTML_TEMPLATE = '''
         </div>
         {% endif %}
 
+        <div id="weather-panel">
         {% if weather %}
         <div class="weather-info">
             <h3><i class="fas fa-thermometer-half"></i> Пиратский прогноз</h3>
@@ -1927,7 +4439,9 @@ HTML_TEMPLATE = '''
             <div class="weather-time">Обновлено: {{ weather.time }}</div>
         </div>
         {% endif %}
+        </div>
 
+        <div id="treasure-panel">
         {% if treasure_info %}
         <div class="treasure-info">
             <h3><i class="fas fa-coins"></i> Совет от копателя:</h3>
@@ -1935,7 +4449,15 @@ HTML_TEMPLATE = '''
                 {{ treasure_info|safe }}
             </div>
         </div>
+        {% elif job_id %}
+        <div class="treasure-info">
+            <h3><i class="fas fa-coins"></i> Совет от копателя:</h3>
+            <div class="expert-advice">
+                <i class="fas fa-spinner fa-spin"></i> Копатель изучает местность...
+            </div>
+        </div>
         {% endif %}
+        </div>
 
         <div class="route-actions">
             <button onclick="saveRoute()"><i class="fas fa-save"></i> Сохранить маршрут</button>
@@ -1944,7 +4466,7 @@ HTML_TEMPLATE = '''
 
         <div class="historical-data">
             <h3><i class="fas fa-history"></i> Исторические данные</h3>
-            <p>{{ historical_data }}</p>
+            <p id="historical-data-text">{% if job_id %}<i class="fas fa-spinner fa-spin"></i> Поднимаем архивы...{% else %}{{ historical_data }}{% endif %}</p>
         </div>
 
         <div class="social-share">
@@ -1988,9 +4510,8 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
-# Глобальная переменная для хранения точек (в реальном приложении используйте БД)
-selected_points = []  # Список для хранения выбранных точек
-selected_routes = []  # Список для хранения маршрутов
+# Точки находок: общее постоянное хранилище и локальный индекс, маршрут — в point_storage
+selected_points = SharedPoints(point_storage)  # Выбранные точки
 
 # Обработчик для главной страницы
 @app.route('/', methods=['GET', 'POST'])
@@ -2000,7 +4521,7 @@ def index():
     old_map = session.get('old_map', False)  # Получаем флаг отображения исторической карты из сессии
     return render_template_string(
         HTML_TEMPLATE,
-        m=create_map(lat, lon, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+        map_html=render_map(lat, lon, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
         query=request.form.get('query', ''),
         map_layer=map_layer,
         old_map=old_map
@@ -2016,7 +4537,7 @@ def search_location_route():
     if not query:
         return render_template_string(
             HTML_TEMPLATE,
-            m=create_map(53.1959, 50.1002, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+            map_html=render_map(53.1959, 50.1002, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
             error="Эй, где будем искать-то? Введи название места!",
             query=query,
             map_layer=map_layer,
@@ -2027,7 +4548,7 @@ def search_location_route():
     if locations:
         return render_template_string(
             HTML_TEMPLATE,
-            m=create_map(53.1959, 50.1002, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+            map_html=render_map(53.1959, 50.1002, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
             locations=locations,
             query=query,
             map_layer=map_layer,
@@ -2036,7 +4557,7 @@ def search_location_route():
 
     return render_template_string(
         HTML_TEMPLATE,
-        m=create_map(53.1959, 50.1002, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+        map_html=render_map(53.1959, 50.1002, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
         error="Ничего не нашел. Может, опечатка? Или место слишком засекречено?",
         query=query,
         map_layer=map_layer,
@@ -2051,6 +4572,92 @@ def select_location():
     selected_points.append((lat, lon))  # Добавляем точку в список выбранных точек
     return '', 200  # Возвращаем пустой ответ с кодом 200
 
+# JSON API для точек: браузер дорисовывает маркеры сам, без перерисовки страницы
+@app.route('/api/points', methods=['GET'])
+def api_points():
+    bbox = request.args.get('bbox')  # Границы видимой области: юг,запад,север,восток
+    if bbox:
+        return api_points_in_bbox(bbox)  # Отдаём только точки из видимой области
+    return Response(_points_json(), mimetype='application/json')  # Все точки и маршрут потоком
+
+# Обработчик для выгрузки координат в бинарном виде (столбец широт, затем долгот)
+@app.route('/api/points.bin', methods=['GET'])
+def api_points_binary():
+    lats, lons = selected_points.column_bytes()  # Сырые буферы столбцов
+    response = Response(iter([lats, lons]), mimetype='application/octet-stream')
+    response.headers['X-Point-Encoding'] = selected_points.encoding  # Как декодировать значения
+    response.headers['Content-Length'] = str(len(lats) + len(lons))
+    return response
+
+# Обработчик для добавления точки через JSON API
+@app.route('/api/points', methods=['POST'])
+def api_add_point():
+    point = _parse_point(request.get_json(silent=True) or request.form)  # Принимаем JSON или форму
+    if point is None:
+        return jsonify({'error': 'Нужны числовые lat и lon'}), 400  # Некорректные координаты
+    selected_points.append(point)  # Добавляем точку в список выбранных точек
+    return jsonify({'point': list(point), 'count': len(selected_points)}), 201  # Возвращаем добавленную точку
+
+# Обработчик для поиска ближайших точек: k ближайших или все в радиусе radius_km
+@app.route('/api/points/nearby', methods=['GET'])
+def api_points_nearby():
+    center = _parse_point(request.args)  # Центр поиска
+    if center is None:
+        return jsonify({'error': 'Нужны числовые lat и lon'}), 400  # Некорректные координаты
+    radius_km = request.args.get('radius_km', type=float)  # Радиус поиска в километрах
+    k = max(1, min(request.args.get('k', 10, type=int), 1000))  # Сколько точек вернуть (не больше 1000)
+
+    if radius_km is not None:
+        found = selected_points.radius(center[0], center[1], radius_km)[:k]  # Точки в радиусе
+    else:
+        found = selected_points.nearest(center[0], center[1], k)  # k ближайших точек
+    return jsonify({
+        'points': [
+            {'lat': lat, 'lon': lon, 'distance_km': round(distance, 3)}
+            for distance, (lat, lon) in found
+        ]
+    })
+
+# Обработчик для поиска исчезнувших деревень рядом с точкой
+@app.route('/api/villages/nearby', methods=['GET'])
+def api_villages_nearby():
+    center = _parse_point(request.args)  # Центр поиска
+    if center is None:
+        return jsonify({'error': 'Нужны числовые lat и lon'}), 400  # Некорректные координаты
+    radius_km = max(0.0, min(request.args.get('radius_km', 10, type=float), 200))  # Радиус поиска (не больше 200 км)
+    limit = max(1, min(request.args.get('limit', 50, type=int), 1000))  # Сколько деревень вернуть
+
+    found = village_index.nearby(center[0], center[1], radius_km, limit)  # Исчезнувшие деревни рядом
+    return jsonify({
+        'villages': [
+            {
+                'name': village['name'],
+                'lat': village['lat'],
+                'lon': village['lon'],
+                'distance_km': round(distance, 3)
+            }
+            for distance, village in found
+        ]
+    })
+
+# Обработчик для получения маршрута через JSON API
+@app.route('/api/routes', methods=['GET'])
+def api_routes():
+    return jsonify({'route': point_storage.get_route()})  # Возвращаем текущий маршрут
+
+# Обработчик для замены маршрута через JSON API
+@app.route('/api/routes', methods=['POST'])
+def api_set_route():
+    data = request.get_json(silent=True) or {}  # Получаем тело запроса
+    route = data.get('route')
+    if not isinstance(route, list):
+        return jsonify({'error': 'Нужен маршрут в виде списка точек'}), 400  # Маршрут не передан
+    saved_route = _parse_route(route)  # Проверяем, что каждая точка — пара чисел
+    if saved_route is None:
+        return jsonify({'error': 'Некорректные точки маршрута'}), 400  # Есть некорректные точки
+    point_storage.set_route(saved_route)  # Заменяем текущий маршрут
+    return jsonify({'route': saved_route}), 200  # Возвращаем сохранённый маршрут
+
 # Обработчик для центрирования карты
 @app.route('/center_map', methods=['GET'])
 def center_map():
@@ -2058,21 +4665,36 @@ def center_map():
     lon = float(request.args.get('lon'))  # Получаем долготу из аргументов запроса
     map_layer = session.get('map_layer', 'satellite')  # Получаем выбранный слой карты из сессии
     old_map = session.get('old_map', False)  # Получаем флаг отображения исторической карты из сессии
-    treasure_info = get_treasure_info(lat, lon)  # Получаем информацию о кладах
-    weather = get_weather(lat, lon)  # Получаем прогноз погоды
-    historical_data = get_historical_data(lat, lon)  # Получаем исторические данные
+
+    job_id = None
+    if ENRICHMENT_JOBS:
+        # Отдаём карту сразу, а клады, погоду и историю считаем в фоне
+        job_id = submit_enrichment_job(lat, lon)  # Панели заполнятся из /jobs/<id>
+        results = {'treasure_info': None, 'weather': None, 'historical_data': None}
+    else:
+        # Опрашиваем источники параллельно, опоздавшие заменяем заглушками
+        results = enrich_point(lat, lon)  # Клады, погода и исторические данные
 
     return render_template_string(
         HTML_TEMPLATE,
-        m=create_map(lat, lon, selected_points, selected_routes, map_layer=map_layer, old_map=old_map),
+        map_html=render_map(lat, lon, selected_points, point_storage.get_route(), map_layer=map_layer, old_map=old_map),
         query=request.args.get('query', ''),
-        treasure_info=treasure_info,
-        weather=weather,
-        historical_data=historical_data,
+        treasure_info=results['treasure_info'],
+        weather=results['weather'],
+        historical_data=results['historical_data'],
+        job_id=job_id,
         map_layer=map_layer,
         old_map=old_map
     )
 
+# Обработчик для получения результата фонового анализа точки
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_store.get(job_id)  # Состояние задания из общего кеша
+    if job is None:
+        return jsonify({'status': 'unknown'}), 404  # Задание не найдено или устарело
+    return jsonify(job)  # pending, done или error с результатом
+
 # Обработчик для чата
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -2090,6 +4712,9 @@ def chat():
 
     Отвечай кратко (5-6 предложения), по делу. Если вопрос не о кладах — откажись отвечать."""
 
+    if 'text/event-stream' in request.headers.get('Accept', ''):  # Клиент читает ответ потоком
+        return stream_chat_response(openrouter_stream(API_KEY, MODEL, prompt, temperature=0.9))
+
     headers = {
         "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json"
@@ -2102,17 +4727,16 @@ def chat():
     }
 
     try:
-        with Session() as session:
-            response = session.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
-            response_text = result['choices'][0]['message']['content']  # Получаем ответ от нейросети
-            return jsonify({"response": response_text})  # Возвращаем ответ в формате JSON
+        response = http_session.post(
+            "https://openrouter.ai/api/v1/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=30
+        )
+        response.raise_for_status()
+        result = response.json()
+        response_text = result['choices'][0]['message']['content']  # Получаем ответ от нейросети
+        return jsonify({"response": response_text})  # Возвращаем ответ в формате JSON
     except Exception as e:
         print(f"Ошибка чата: {e}")  # Выводим ошибку, если она есть
         return jsonify({"response": "Чёрт- побери, связь барахлит... Попробуй позже."})  # Возвращаем сообщение об ошибке
@@ -2120,16 +4744,19 @@ def chat():
 # Обработчик для сохранения маршрута
 @app.route('/save_route', methods=['POST'])
 def save_route():
-    route = request.form.get('route')  # Получаем маршрут из формы
-    if route:
-        session['route'] = json.loads(route)  # Сохраняем маршрут в сессии
-        return '', 200  # Возвращаем пустой ответ с кодом 200
-    return '', 400  # Возвращаем пустой ответ с кодом 400, если маршрут не передан
+    try:
+        route = _parse_route(json.loads(request.form.get('route') or 'null'))  # Получаем маршрут из формы
+    except ValueError:
+        route = None  # Маршрут не разобрался как JSON
+    if route is None:
+        return '', 400  # Возвращаем пустой ответ с кодом 400, если маршрут не передан или некорректен
+    point_storage.set_route(route)  # Сохраняем маршрут в общем хранилище (видят все воркеры)
+    return '', 200  # Возвращаем пустой ответ с кодом 200
 
 # Обработчик для загрузки маршрута
 @app.route('/load_route', methods=['GET'])
 def load_route():
-    route = session.get('route', [])  # Получаем маршрут из сессии
+    route = point_storage.get_route()  # Получаем маршрут из общего хранилища
     return jsonify({"route": route})  # Возвращаем маршрут в формате JSON
 
 # Обработчик для изменения слоя карты
@@ -2146,6 +4773,18 @@ def toggle_old_map():
     session['old_map'] = old_map  # Сохраняем флаг отображения исторической карты в сессии
     return '', 200  # Возвращаем пустой ответ с кодом 200
 
+# Обработчик для статистики кешей (попадания и промахи в текущем воркере)
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'geocode': geocode_cache.stats(),  # Прямое геокодирование
+        'reverse_geocode': reverse_geocode_cache.stats(),  # Обратное геокодирование
+        'map_render': map_render_cache.stats(),  # Готовые карты
+        'pages': page_cache.stats(),  # Загруженные страницы источников
+        'llm': llm_cache.stats(),  # Ответы нейросети
+        'singleflight': singleflight.stats()  # Склеенные одновременные запросы
+    })
+
 # Запускаем приложение
 if __name__ == '__main__':
     app.run(debug=True, port=5001)  # Запускаем приложение на порту 5001